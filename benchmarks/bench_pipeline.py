@@ -0,0 +1,58 @@
+# Benchmarks relying on a local stub server, that require pytest-benchmark.
+# USAGE: pytest benchmarks/bench_pipeline.py
+import os
+
+from bs4 import BeautifulSoup
+import pytest
+
+from conftest import clear_thumbnails
+from stub_server import LINK_TEMPLATES
+from image_preview_thumbnailer import download_img, process_all_links_in_html, reset_build_caches, resize_as_thumbnail, select_anchor_tags
+
+pytest.importorskip('pytest_benchmark')
+
+LINKS_PER_KIND = int(os.environ.get('BENCH_LINKS_PER_KIND', '10'))
+ROUNDS = int(os.environ.get('BENCH_ROUNDS', '3'))
+
+
+def page_html(kinds, links_per_kind=LINKS_PER_KIND):
+    items = '\n'.join(f'<li><a href="{LINK_TEMPLATES[kind].format(i=i)}">{kind} {i}</a></li>' for kind in kinds for i in range(links_per_kind))
+    return f'<html><head><title>Benchmark</title></head><body><ul>\n{items}\n</ul></body></html>'
+
+@pytest.mark.parametrize('kind', sorted(LINK_TEMPLATES))
+def test_cold_cache_per_kind(benchmark, bench_config, kind):
+    html = page_html([kind])
+    out_html = benchmark.pedantic(process_all_links_in_html, args=(html, bench_config), setup=lambda: clear_thumbnails(bench_config), rounds=ROUNDS)
+    assert out_html.count('<img') == LINKS_PER_KIND
+
+@pytest.mark.parametrize('max_workers', (1, 8))
+def test_cold_cache_all_kinds(benchmark, bench_config, max_workers):
+    bench_config.max_workers = max_workers
+    html = page_html(LINK_TEMPLATES)
+    out_html = benchmark.pedantic(process_all_links_in_html, args=(html, bench_config), setup=lambda: clear_thumbnails(bench_config), rounds=ROUNDS)
+    assert out_html.count('<img') == LINKS_PER_KIND * len(LINK_TEMPLATES)
+
+def test_warm_cache_all_kinds(benchmark, bench_config):
+    html = page_html(LINK_TEMPLATES)
+    process_all_links_in_html(html, bench_config)
+    # The thumbnails index is rebuilt for every round, like for every new build:
+    out_html = benchmark.pedantic(process_all_links_in_html, args=(html, bench_config), setup=reset_build_caches, rounds=ROUNDS * 10)
+    assert out_html.count('<img') == LINKS_PER_KIND * len(LINK_TEMPLATES)
+
+def test_link_extraction(benchmark, bench_config):
+    html = page_html(LINK_TEMPLATES, links_per_kind=100 * LINKS_PER_KIND)
+    anchor_tags = benchmark(lambda: select_anchor_tags(BeautifulSoup(html, bench_config.html_parser), bench_config))
+    assert len(anchor_tags) == 100 * LINKS_PER_KIND * len(LINK_TEMPLATES)
+
+def test_download(benchmark, bench_config):
+    def download():
+        out_filepath = download_img(LINK_TEMPLATES['bare_jpg'].format(i=0), bench_config)
+        os.remove(out_filepath)
+    benchmark.pedantic(download, rounds=ROUNDS * 10)
+
+def test_resize(benchmark, bench_config, stub_server):
+    img_filepath, out_filepath = bench_config.fs_thumbs_dir('original.jpg'), bench_config.fs_thumbs_dir('resized.jpg')
+    with open(img_filepath, 'wb') as img_file:
+        img_file.write(stub_server.jpg_content)
+    benchmark(resize_as_thumbnail, img_filepath, bench_config.thumb_size, out_filepath)
+    assert os.path.exists(out_filepath)
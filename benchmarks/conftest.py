@@ -0,0 +1,42 @@
+# Fixtures for the benchmarks, that can be configured through those environment variables:
+# - BENCH_STUB_LATENCY: delay in seconds before the stub server answers a request
+# - BENCH_STUB_IMG_SIZE: dimensions of the images served, e.g. 2000x1500
+# - BENCH_STUB_PAGE_KB: size of the HTML pages served
+import os, shutil, sys
+
+import pytest
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint: disable=wrong-import-order,wrong-import-position
+from image_preview_thumbnailer import HTTP_POOLS_PER_SESSION, PluginConfig, http_session, reset_build_caches
+from stub_server import StubRedirectAdapter, StubServer
+
+SRC_IMG = os.path.join(os.path.dirname(__file__), '..', 'test_content', 'LadyofHats_DnD_Unicorn.jpg')
+
+
+@pytest.fixture(scope='session')
+def stub_server():
+    img_size = tuple(int(dim) for dim in os.environ.get('BENCH_STUB_IMG_SIZE', '2000x1500').split('x'))
+    with StubServer(SRC_IMG, img_size=img_size,
+                    latency=float(os.environ.get('BENCH_STUB_LATENCY', '0.02')),
+                    page_padding_bytes=int(os.environ.get('BENCH_STUB_PAGE_KB', '100')) * 1024) as server:
+        yield server
+
+@pytest.fixture
+def bench_config(stub_server, tmp_path):  # pylint: disable=redefined-outer-name
+    config = PluginConfig({'output_path': str(tmp_path)})
+    os.makedirs(config.fs_thumbs_dir())
+    session = http_session(config)
+    adapter_kwargs = {'pool_connections': HTTP_POOLS_PER_SESSION, 'pool_maxsize': config.max_conns_per_host, 'pool_block': True}
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, StubRedirectAdapter(stub_server.url, **adapter_kwargs))
+    yield config
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(**adapter_kwargs))
+    reset_build_caches()
+
+def clear_thumbnails(config):  # simulates a new build, with a cold thumbnails cache
+    shutil.rmtree(config.fs_thumbs_dir())
+    os.makedirs(config.fs_thumbs_dir())
+    reset_build_caches()
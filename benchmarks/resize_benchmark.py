@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Compares the CPU time & peak memory usage of resize_as_thumbnail()
+# with the previous implementation, that was simply calling Image.thumbnail().
+# USAGE: python benchmarks/resize_benchmark.py [--runs N]
+# Every measure is performed in a fresh process, so that peak RSS values are not polluted by previous runs.
+import argparse, multiprocessing, os, resource, shutil, sys, tempfile
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from image_preview_thumbnailer import DEFAULT_THUMB_SIZE, resize_as_thumbnail  # pylint: disable=wrong-import-position
+
+SOURCE_IMG = os.path.join(os.path.dirname(__file__), '..', 'test_content', 'LadyofHats_DnD_Unicorn.jpg')
+SOURCE_SIZES = ((1600, 1200), (4000, 3000), (6000, 4000), (8000, 5000))
+
+
+def legacy_resize_as_thumbnail(img_filepath, max_size):
+    img = Image.open(img_filepath)
+    img.thumbnail((max_size, max_size))
+    img.save(img_filepath)
+
+def new_resize_as_thumbnail(img_filepath, max_size):
+    resize_as_thumbnail(img_filepath, max_size)
+
+def peak_rss_kib():
+    # Under Linux, ru_maxrss is inherited from the parent process, whereas VmHWM is not:
+    try:
+        with open('/proc/self/status', encoding='utf8') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(resize_func, src_filepath, runs, results):
+    work_filepath = src_filepath + '.work' + os.path.splitext(src_filepath)[1]
+    rss_before = peak_rss_kib()
+    cpu_time = 0
+    for _ in range(runs):
+        shutil.copy(src_filepath, work_filepath)
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        resize_func(work_filepath, DEFAULT_THUMB_SIZE)
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time += (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    os.remove(work_filepath)
+    rss_after = peak_rss_kib()
+    results.put((cpu_time / runs, (rss_after - rss_before) / 1024))
+
+def measure_in_subprocess(resize_func, src_filepath, runs):
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=measure, args=(resize_func, src_filepath, runs, results))
+    process.start()
+    cpu_time, peak_rss_mib = results.get()
+    process.join()
+    return cpu_time, peak_rss_mib
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with Image.open(SOURCE_IMG) as img:
+            src_img = img.convert('RGB')
+        print(f'{"source image":>22} | {"legacy CPU":>10} | {"new CPU":>10} | {"legacy peak RSS":>15} | {"new peak RSS":>15}')
+        for width, height in SOURCE_SIZES:
+            for img_format, ext in (('JPEG', '.jpg'), ('PNG', '.png')):
+                src_filepath = os.path.join(tmp_dir, f'{width}x{height}{ext}')
+                src_img.resize((width, height)).save(src_filepath, format=img_format)
+                legacy_cpu, legacy_rss = measure_in_subprocess(legacy_resize_as_thumbnail, src_filepath, args.runs)
+                new_cpu, new_rss = measure_in_subprocess(new_resize_as_thumbnail, src_filepath, args.runs)
+                print(f'{img_format:>4} {width:>5}x{height:<5} px | {legacy_cpu * 1000:>7.1f} ms | {new_cpu * 1000:>7.1f} ms'
+                      f' | {legacy_rss:>11.1f} MiB | {new_rss:>11.1f} MiB')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Compares the 'soup' & 'splice' HTML rewriters on a generated page, with all its thumbnails already present,
+# so that no network request is performed.
+# USAGE: python benchmarks/rewrite_benchmark.py [--links N] [--runs N]
+import argparse, os, shutil, sys, tempfile, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from image_preview_thumbnailer import PluginConfig, process_all_links_in_html  # pylint: disable=wrong-import-position
+
+
+def generate_page(links_count):
+    items = '\n'.join(f'    <li><a href="https://example.com/images/img{i}.jpg">Image {i}</a>: some <em>description</em> &amp; more</li>'
+                      for i in range(links_count))
+    paragraphs = '\n'.join(f'  <p>Paragraph {i} with <a href="/internal/{i}.html">an internal link</a></p>' for i in range(links_count))
+    return f'<!DOCTYPE html>\n<html lang="en">\n<head><title>Benchmark</title></head>\n<body>\n<article>\n  <ul>\n{items}\n  </ul>\n{paragraphs}\n</article>\n</body>\n</html>'
+
+def measure(html, config, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process_all_links_in_html(html, config)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    process_all_links_in_html(html, config)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(durations), peak_memory
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--links', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    output_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(output_dir, 'thumbnails'))
+        for i in range(args.links):
+            with open(os.path.join(output_dir, 'thumbnails', f'img{i}.jpg'), 'wb') as thumb_file:
+                thumb_file.write(b'dummy')
+        html = generate_page(args.links)
+        print(f'Page size: {len(html) / 1024:.0f} KiB - {args.links} image links')
+        for html_rewriter in ('soup', 'splice'):
+            config = PluginConfig({'output_path': output_dir, 'html_rewriter': html_rewriter})
+            duration, peak_memory = measure(html, config, args.runs)
+            print(f'{html_rewriter:>6}: {duration * 1000:8.1f} ms - peak memory allocated: {peak_memory / 1024 / 1024:6.1f} MiB')
+    finally:
+        shutil.rmtree(output_dir)
+
+if __name__ == '__main__':
+    main()
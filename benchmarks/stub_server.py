@@ -0,0 +1,102 @@
+# Local HTTP server mimicking the image hosting websites supported by this plugin,
+# with a configurable latency & configurable payload sizes.
+# StubRedirectAdapter can be mounted on the plugin HTTP session, in order to send it all requests.
+import json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import urlparse
+
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# Links to be used in benchmark pages, per kind of page, where {i} is a unique identifier:
+LINK_TEMPLATES = {
+    'artstation': 'https://www.artstation.com/artwork/art{i}',
+    'bare_jpg': 'https://images.example.com/photos/photo{i}.jpg',
+    'dafont': 'https://www.dafont.com/font{i}.font',
+    'freesvg': 'https://freesvg.org/vector{i}',
+    'og_image': 'https://www.flickr.com/photos/someone/{i}/',
+    'wikipedia': 'https://commons.wikimedia.org/wiki/File:Picture{i}.png',
+}
+
+
+class StubServer:
+    def __init__(self, src_img_filepath, img_size=(2000, 1500), latency=0, page_padding_bytes=100 * 1024):
+        with Image.open(src_img_filepath) as img:
+            src_img = img.convert('RGB').resize(img_size)
+        self.latency = latency
+        self.page_padding = b'<p>' + b'Lorem ipsum dolor sit amet. ' * (page_padding_bytes // 28) + b'</p>'
+        self.jpg_content = self._encode(src_img, 'JPEG')
+        self.png_content = self._encode(src_img, 'PNG')
+        self.svg_content = b'<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100"><circle cx="50" cy="50" r="40"/></svg>'
+        self.requests_count = 0
+        handler_class = type('StubRequestHandler', (StubRequestHandler,), {'stub': self})
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+    def __enter__(self):
+        self._thread.start()
+        return self
+    def __exit__(self, *_):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+    @staticmethod
+    def _encode(img, img_format):
+        out = BytesIO()
+        img.save(out, format=img_format)
+        return out.getvalue()
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # enables keep-alive
+    stub = None  # StubServer, defined by subclasses
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.stub.requests_count += 1
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        host, _, path = self.path.lstrip('/').partition('/')
+        path = '/' + path
+        if path.startswith('/img/'):
+            if path.endswith('.svg'):
+                self._reply('image/svg+xml', self.stub.svg_content)
+            elif path.endswith('.png'):
+                self._reply('image/png', self.stub.png_content)
+            else:
+                self._reply('image/jpeg', self.stub.jpg_content)
+        elif host == 'www.artstation.com':
+            artwork_id = path.split('/')[-1].replace('.json', '')
+            self._reply('application/json', json.dumps({'assets': [{'image_url': f'https://cdna.artstation.com/img/{artwork_id}.jpg'}]}).encode())
+        elif host == 'www.dafont.com':
+            self._reply_html(f'<div class="preview" style="background-image:url(/img/preview{path}.png)"></div>')
+        elif host == 'commons.wikimedia.org':
+            self._reply_html(f'<a class="internal" href="//upload.wikimedia.org/img{path.replace("/wiki/File:", "/")}">Original file</a>')
+        elif host == 'freesvg.org':
+            self._reply_html(f'<img class="vec_veliki" src="/img{path}.svg">')
+        elif path.endswith('.jpg'):  # "bare" image link
+            self._reply('image/jpeg', self.stub.jpg_content)
+        else:
+            self._reply_html('', head=f'<meta property="og:image" content="https://live.staticflickr.com/img{path.rstrip("/")}.jpg">')
+    def _reply_html(self, body, head=''):
+        html = f'<html><head><title>Stub page</title>{head}</head><body>{body}'.encode() + self.stub.page_padding + b'</body></html>'
+        self._reply('text/html; charset=utf-8', html)
+    def _reply(self, content_type, content):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):  # the client may close the connection early, e.g. after </head>
+            pass
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+# Sends every request to the stub server, prefixing the URL path with the original hostname:
+class StubRedirectAdapter(HTTPAdapter):
+    def __init__(self, stub_url, **kwargs):
+        super().__init__(**kwargs)
+        self.stub_url = stub_url
+    def send(self, request, *args, **kwargs):  # pylint: disable=arguments-differ
+        parsed = urlparse(request.url)
+        request.url = f'{self.stub_url}/{parsed.netloc}{parsed.path}' + (f'?{parsed.query}' if parsed.query else '')
+        return super().send(request, *args, **kwargs)
@@ -2,34 +2,86 @@
 # CLI USAGE:
 #  cd path/to/pelican/output/dir
 #  ./image_preview_thumbnailer.py path/to/page.html
-# pylint: disable=attribute-defined-outside-init,redefined-builtin,redefined-outer-name,use-dict-literal
-import logging, os, re, sys, warnings
-from glob import glob
+#  ./image_preview_thumbnailer.py --config pelicanconf.py --prefetch output/
+#  ./image_preview_thumbnailer.py --drain-pending [path/to/cache/dir]
+#  ./image_preview_thumbnailer.py --help
+# pylint: disable=attribute-defined-outside-init,redefined-builtin,redefined-outer-name,too-many-lines,use-dict-literal
+import argparse, asyncio, codecs, contextvars, json, logging, multiprocessing, os, re, threading, time, warnings
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import as_completed, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 try:
     from contextlib import nullcontext
 except ImportError:  # => Python 3.6
     from contextlib import suppress as nullcontext
+from glob import glob
+from functools import lru_cache, partial, wraps
+from hashlib import sha256
+from html import escape as html_escape
+from html.parser import HTMLParser
+from importlib.metadata import entry_points
 from tempfile import mkstemp
+from types import SimpleNamespace
 from urllib.parse import unquote, urljoin, urlparse
 
+try:
+    import aiohttp
+except ImportError:  # => IMAGE_PREVIEW_THUMBNAILER_HTTP_CLIENT = 'aiohttp' is not available
+    aiohttp = None
 from bs4 import BeautifulSoup
 from pelican import signals
+from pelican.settings import read_settings
 from PIL import Image
+try:
+    import pillow_avif  # pylint: disable=unused-import  # registers the AVIF format, for Pillow versions that do not support it natively
+except ImportError:
+    pass
 import requests
-from requests.exceptions import ConnectionError, ConnectTimeout
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
 from urllib3.exceptions import InsecureRequestWarning
 
+DEFAULT_ASYNC_MAX_CONCURRENCY = 100  # in-flight requests performed by the asyncio engine
+DEFAULT_BUILD_DEADLINE = 0  # => no time limit
+DEFAULT_CACHE_DIR = os.path.join('cache', 'image_preview_thumbnailer')
 DEFAULT_CERT_VERIFY = True
+DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 0  # => once tripped, a circuit breaker stays open until the end of the build
+DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 5  # consecutive timeouts or HTTP 403/429 responses
 DEFAULT_ENCODING = 'utf-8'
 DEFAULT_HTML_PARSER = 'html.parser'  # Alt: 'html5lib', 'lxml', 'lxml-xml'
+DEFAULT_HTML_REWRITER = 'soup'  # Alt: 'splice'
+DEFAULT_HTTP_CLIENT = 'requests'  # Alt: 'aiohttp'
+DEFAULT_HTTP_RETRIES = 0
 DEFAULT_SILENT_HTTP_ERRORS = True
 DEFAULT_IGNORE_404 = False
 DEFAULT_INSERTED_HTML = '<a href="{link}" target="_blank" class="preview-thumbnail"><img loading="lazy" src="{thumb}" class="preview-thumbnail"></a>'
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+DEFAULT_MAX_IMG_PIXELS = Image.MAX_IMAGE_PIXELS
+DEFAULT_MAX_REQUESTS_PER_SECOND = 0  # => no rate limiting
+DEFAULT_META_MAX_BYTES = 256 * 1024
+DEFAULT_NEGATIVE_CACHE_TTLS = {  # in seconds, per failure reason, None meaning that the image download is never retried
+    'connection_error': 24 * 3600,
+    'decompression_bomb': None,
+    'http_404': 30 * 24 * 3600,
+    'http_error': 24 * 3600,
+    'no_image': 7 * 24 * 3600,  # the downloader could not find any image URL
+    'too_large': 30 * 24 * 3600,
+    'unsupported_content_type': 30 * 24 * 3600,
+}
+DEFAULT_MAX_WORKERS = 1  # => links are processed sequentially
 DEFAULT_SELECTOR = 'body'
 DEFAULT_THUMBS_DIR = 'thumbnails'
 DEFAULT_THUMB_SIZE = 300
 DEFAULT_TIMEOUT = 5
 DEFAULT_USER_AGENT = 'pelican-plugin-image-preview-thumbnailer'
+RESAMPLING = getattr(Image, 'Resampling', Image)  # enum introduced in Pillow 9.1
+RESIZE_REDUCING_GAP = 2  # cf. Image.thumbnail() documentation
+VARIANT_SAVE_OPTIONS = {  # encoder settings per format, for thumbnail variants
+    'AVIF': {'quality': 60, 'speed': 6},
+    'WEBP': {'quality': 80, 'method': 6},
+}
 
 EXT_PER_CONTENT_TYPE = {
     'image/gif': '.gif',
@@ -39,6 +91,29 @@ EXT_PER_CONTENT_TYPE = {
     'image/svg+xml': '.svg',
 }
 
+CIRCUIT_BREAKER_STATUS_CODES = (403, 429)
+HTTP_CHUNK_SIZE = 64 * 1024
+HTTP_RETRY_BACKOFF = 0.5  # in seconds, doubled after every attempt
+HTTP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HTTP_POOLS_PER_SESSION = 100  # number of hosts for which connections are kept alive
+LATENCY_HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5)  # in seconds
+
+MAX_HTTP_ERROR_CONTENT_BYTES = 64 * 1024
+PAGE_CACHE_CONFIG_KEYS = ('content_addressed', 'except_urls', 'html_parser', 'html_rewriter', 'inserted_html', 'output_path', 'rel_thumbs_dir', 'selector',
+                          'thumb_size', 'variants_formats', 'variants_sizes')
+PAGE_CACHE_FORMAT_VERSION = '2'
+PENDING_LINKS_CONFIG_KEYS = ('cache_dir', 'cert_verify', 'content_addressed', 'html_parser', 'ignore_404', 'max_download_bytes', 'max_img_pixels', 'meta_max_bytes',
+                             'negative_cache_ttls', 'output_path', 'rel_thumbs_dir', 'silent_http_errors', 'thumb_size', 'timeout', 'user_agent',
+                             'variants_formats', 'variants_sizes')
+PENDING_LINKS_FILENAME = 'pending.json'
+CONTENT_HASH_LENGTH = 32  # in hexadecimal characters, for both thumbnails content & URLs
+URL_HASHES_FILENAME = '.url_hashes.jsonl'  # stored in the thumbnails directory
+
+DOWNLOADERS_ENTRY_POINT_GROUP = 'image_preview_thumbnailer.downloaders'
+URL_REGEX_HOSTNAME_REGEX = re.compile(r'https\??://((?:[\w-]|\\?\.)+)/')  # extracts fixed hostnames from URL regexes
+NEWLINE_REGEX = re.compile('\n')
+VOID_ELEMENTS = ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr')
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -53,15 +128,7 @@ def process_all_links(path, context):
     config = PluginConfig.from_metadata(content.metadata, context)
     if not config:  # => this plugin has not been enabled on this page
         return
-    os.makedirs(config.fs_thumbs_dir(), exist_ok=True)
-    with nullcontext() if config.cert_verify else warnings.catch_warnings():
-        if not config.cert_verify:
-            warnings.simplefilter('ignore', InsecureRequestWarning)
-        with open(path, "r+", encoding=config.encoding) as html_file:
-            edited_html = process_all_links_in_html(html_file, config)
-            html_file.seek(0)
-            html_file.truncate()
-            html_file.write(edited_html)
+    process_html_file(path, config)
 
 class PluginConfig(dict):
     __getattr__ = dict.__getitem__
@@ -69,23 +136,48 @@ class PluginConfig(dict):
     def __init__(self, odict=None):
         super().__init__(odict or {})
         self.setdefault('output_path', '')
+        self.setdefault('async_max_concurrency', DEFAULT_ASYNC_MAX_CONCURRENCY)
+        self.setdefault('build_deadline', DEFAULT_BUILD_DEADLINE)
+        self.setdefault('cache_dir', DEFAULT_CACHE_DIR)
         self.setdefault('cert_verify', DEFAULT_CERT_VERIFY)
+        self.setdefault('content_addressed', False)
+        self.setdefault('deferred_html', '')  # => nothing is inserted after links whose thumbnail generation has been deferred
+        self.setdefault('circuit_breaker_cooldown', DEFAULT_CIRCUIT_BREAKER_COOLDOWN)
+        self.setdefault('circuit_breaker_threshold', DEFAULT_CIRCUIT_BREAKER_THRESHOLD)
         self.setdefault('encoding', DEFAULT_ENCODING)
         self.setdefault('except_urls', '')
         self.setdefault('html_parser', DEFAULT_HTML_PARSER)
+        self.setdefault('html_rewriter', DEFAULT_HTML_REWRITER)
+        self.setdefault('http_client', DEFAULT_HTTP_CLIENT)
+        self.setdefault('http_retries', DEFAULT_HTTP_RETRIES)
         self.setdefault('silent_http_errors', DEFAULT_SILENT_HTTP_ERRORS)
         self.setdefault('ignore_404', DEFAULT_IGNORE_404)
         self.setdefault('inserted_html', DEFAULT_INSERTED_HTML)
+        self.setdefault('max_conns_per_host', DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self.setdefault('max_download_bytes', DEFAULT_MAX_DOWNLOAD_BYTES)
+        self.setdefault('max_img_pixels', DEFAULT_MAX_IMG_PIXELS)
+        self.setdefault('max_requests_per_second', DEFAULT_MAX_REQUESTS_PER_SECOND)
+        self.setdefault('max_workers', DEFAULT_MAX_WORKERS)
+        self.setdefault('meta_max_bytes', DEFAULT_META_MAX_BYTES)
+        self.negative_cache_ttls = {**DEFAULT_NEGATIVE_CACHE_TTLS, **self.get('negative_cache_ttls', {})}
+        self.setdefault('page_cache', False)
         self.setdefault('rel_thumbs_dir', DEFAULT_THUMBS_DIR)
+        self.setdefault('resize_workers', 0)  # => images are resized by the thread that downloaded them
         self.setdefault('selector', DEFAULT_SELECTOR)
         self.setdefault('thumb_size', DEFAULT_THUMB_SIZE)
         self.setdefault('timeout', DEFAULT_TIMEOUT)
         self.setdefault('user_agent', DEFAULT_USER_AGENT)
+        self.setdefault('variants_formats', [])  # e.g. ['WEBP', 'AVIF']
+        self.setdefault('variants_sizes', [])  # e.g. [600] for high-DPI screens
         # pylint: disable=access-member-before-definition
         if self.except_urls and isinstance(self.except_urls, str):
-            self.except_urls = [re.compile(regex) for regex in self.except_urls.split(',')]
+            self.except_urls = self.except_urls.split(',')
+        if self.except_urls and not isinstance(self.except_urls, re.Pattern):
+            self.except_urls = combined_regex(tuple(getattr(regex, 'pattern', regex) for regex in self.except_urls))
         if isinstance(self.selector, str):
             self.selector = self.selector.split(',')
+        if self.resize_workers is True:
+            self.resize_workers = os.cpu_count()
     @classmethod
     def from_metadata(cls, metadata, settings):
         enabled = metadata.get('image-preview-thumbnailer') or settings.get('IMAGE_PREVIEW_THUMBNAILER')
@@ -98,13 +190,36 @@ class PluginConfig(dict):
             if value is not None:
                 attrs[key] = value
         set_attr('output_path', settings.get('OUTPUT_PATH'))
+        if settings.get('CACHE_PATH'):
+            set_attr('cache_dir', os.path.join(settings['CACHE_PATH'], 'image_preview_thumbnailer'))
         # Global configuration entries:
+        set_attr('async_max_concurrency', settings.get('IMAGE_PREVIEW_THUMBNAILER_ASYNC_MAX_CONCURRENCY'))
+        set_attr('build_deadline', settings.get('IMAGE_PREVIEW_THUMBNAILER_BUILD_DEADLINE'))
         set_attr('cert_verify', settings.get('IMAGE_PREVIEW_THUMBNAILER_CERT_VERIFY'))
+        set_attr('circuit_breaker_cooldown', settings.get('IMAGE_PREVIEW_THUMBNAILER_CIRCUIT_BREAKER_COOLDOWN'))
+        set_attr('circuit_breaker_threshold', settings.get('IMAGE_PREVIEW_THUMBNAILER_CIRCUIT_BREAKER_THRESHOLD'))
+        set_attr('content_addressed', settings.get('IMAGE_PREVIEW_THUMBNAILER_CONTENT_ADDRESSED'))
+        set_attr('deferred_html', settings.get('IMAGE_PREVIEW_THUMBNAILER_DEFERRED_HTML'))
         set_attr('encoding', settings.get('IMAGE_PREVIEW_THUMBNAILER_ENCODING'))
         set_attr('html_parser', settings.get('IMAGE_PREVIEW_THUMBNAILER_HTML_PARSER'))
+        set_attr('html_rewriter', settings.get('IMAGE_PREVIEW_THUMBNAILER_HTML_REWRITER'))
+        set_attr('http_client', settings.get('IMAGE_PREVIEW_THUMBNAILER_HTTP_CLIENT'))
+        set_attr('http_retries', settings.get('IMAGE_PREVIEW_THUMBNAILER_HTTP_RETRIES'))
+        set_attr('max_conns_per_host', settings.get('IMAGE_PREVIEW_THUMBNAILER_MAX_CONNECTIONS_PER_HOST'))
+        set_attr('max_download_bytes', settings.get('IMAGE_PREVIEW_THUMBNAILER_MAX_DOWNLOAD_BYTES'))
+        set_attr('max_img_pixels', settings.get('IMAGE_PREVIEW_THUMBNAILER_MAX_IMAGE_PIXELS'))
+        set_attr('max_requests_per_second', settings.get('IMAGE_PREVIEW_THUMBNAILER_MAX_REQUESTS_PER_SECOND'))
+        set_attr('max_workers', settings.get('IMAGE_PREVIEW_THUMBNAILER_MAX_WORKERS'))
+        set_attr('meta_max_bytes', settings.get('IMAGE_PREVIEW_THUMBNAILER_META_MAX_BYTES'))
+        set_attr('negative_cache_ttls', settings.get('IMAGE_PREVIEW_THUMBNAILER_NEGATIVE_CACHE_TTLS'))
+        set_attr('cache_dir', settings.get('IMAGE_PREVIEW_THUMBNAILER_CACHE_DIR'))
+        set_attr('page_cache', settings.get('IMAGE_PREVIEW_THUMBNAILER_PAGE_CACHE'))
         set_attr('rel_thumbs_dir', settings.get('IMAGE_PREVIEW_THUMBNAILER_DIR'))
+        set_attr('resize_workers', settings.get('IMAGE_PREVIEW_THUMBNAILER_RESIZE_WORKERS'))
         set_attr('timeout', settings.get('IMAGE_PREVIEW_THUMBNAILER_REQUEST_TIMEOUT'))
         set_attr('user_agent', settings.get('IMAGE_PREVIEW_THUMBNAILER_USERAGENT'))
+        set_attr('variants_formats', settings.get('IMAGE_PREVIEW_THUMBNAILER_VARIANTS_FORMATS'))
+        set_attr('variants_sizes', settings.get('IMAGE_PREVIEW_THUMBNAILER_VARIANTS_SIZES'))
         # Configuration entries that can be configured either globally or per article/page:
         set_attr('selector', (enabled if enabled is not True else None) or settings.get('IMAGE_PREVIEW_THUMBNAILER_SELECTOR'))
         set_attr('except_urls', metadata.get('image-preview-thumbnailer-except-urls') or settings.get('IMAGE_PREVIEW_THUMBNAILER_EXCEPT_URLS'))
@@ -120,58 +235,719 @@ class PluginConfig(dict):
         return fs_dir
 
 def process_all_links_in_html(html_file, config=PluginConfig()):
-    soup = BeautifulSoup(html_file, config.html_parser)
-    anchor_tags = set()
+    return _process_all_links_in_html(html_file, config)[0]
+
+# With prefetch=True, thumbnails are generated but the HTML file is left untouched.
+# Returns the number of links processed, or None if the page was retrieved from the page cache.
+def process_html_file(path, config=PluginConfig(), prefetch=False):
+    os.makedirs(config.fs_thumbs_dir(), exist_ok=True)
+    if config.build_deadline:  # => the pending links list of this cache directory will be updated at the end of the build
+        with _PENDING_LINKS_LOCK:
+            _PENDING_LINKS.setdefault(config.cache_dir, {})
+    with nullcontext() if config.cert_verify else warnings.catch_warnings():
+        if not config.cert_verify:
+            warnings.simplefilter('ignore', InsecureRequestWarning)
+        if prefetch:
+            with open(path, encoding=config.encoding) as html_file:
+                return len(prefetch_thumbnails(html_file, config))
+        with open(path, "r+", encoding=config.encoding) as html_file:
+            html = html_file.read()
+            edited_html = load_cached_page(path, html, config) if config.page_cache else None
+            if config.page_cache:
+                STATS.incr('page_cache_misses' if edited_html is None else 'page_cache_hits')
+            hrefs = None
+            if edited_html is None:
+                edited_html, hrefs = _process_all_links_in_html(html, config)
+                if config.page_cache:
+                    save_cached_page(path, html, edited_html, hrefs, config)
+            html_file.seek(0)
+            html_file.truncate()
+            html_file.write(edited_html)
+            return None if hrefs is None else len(hrefs)
+
+def _process_all_links_in_html(html_file, config):  # also returns the list of links processed
+    html = html_file.read() if hasattr(html_file, 'read') else html_file
+    with STATS.timer('html_parsing'):
+        soup = BeautifulSoup(html, config.html_parser)
+        anchor_tags = select_anchor_tags(soup, config)
+    hrefs = [anchor_tag['href'] for anchor_tag in anchor_tags]
+    rel_thumb_filepaths = _resolve_thumbnails(hrefs, config)
+    thumbnails = [(anchor_tag, rel_thumb_filepath) for anchor_tag, rel_thumb_filepath in zip(anchor_tags, rel_thumb_filepaths)
+                  if rel_thumb_filepath and (rel_thumb_filepath is not DEFERRED_THUMBNAIL or config.deferred_html)]
+    with STATS.timer('html_rewriting'):
+        if config.html_rewriter == 'splice':
+            edited_html = splice_thumbnails(html, thumbnails, config)
+            if edited_html is not None:
+                return edited_html, hrefs
+            LOGGER.info("Could not locate all <a> tags in source HTML: falling back to BeautifulSoup serialization")
+        for anchor_tag, rel_thumb_filepath in thumbnails:
+            insert_thumbnail(anchor_tag, rel_thumb_filepath, config)
+        return str(soup), hrefs
+
+def prefetch_thumbnails(html_file, config=PluginConfig()):  # returns the links processed
+    html = html_file.read() if hasattr(html_file, 'read') else html_file
+    with STATS.timer('html_parsing'):
+        hrefs = [anchor_tag['href'] for anchor_tag in select_anchor_tags(BeautifulSoup(html, config.html_parser), config)]
+    _resolve_thumbnails(hrefs, config)
+    return hrefs
+
+def _resolve_thumbnails(urls, config):
+    return ASYNC_ENGINE.run(_async_resolve_thumbnails(urls, config))
+
+async def _async_resolve_thumbnails(urls, config):
+    if config.max_workers > 1:
+        # All the links of the page are resolved concurrently by the asyncio engine, in the limit of IMAGE_PREVIEW_THUMBNAILER_ASYNC_MAX_CONCURRENCY
+        # requests in flight, but the HTML is only edited from the calling thread. Like with a threads pool, all links are processed before an error is raised:
+        thumbnails = await asyncio.gather(*(async_resolve_thumbnail(url, config) for url in urls), return_exceptions=True)
+        for thumbnail in thumbnails:
+            if isinstance(thumbnail, BaseException):
+                raise thumbnail
+        return thumbnails
+    return [await async_resolve_thumbnail(url, config) for url in urls]
+
+def select_anchor_tags(soup, config=PluginConfig()):
+    anchor_tags = {}  # using a dict as an ordered set, so that links are always processed in the same order
     for css_selector in config.selector:
         for content in soup.select(css_selector):
             for anchor_tag in content.find_all("a"):
                 if not anchor_tag['href'].startswith('http'):
                     continue  # internal links are not supported for now
-                if any(regex.search(anchor_tag['href']) for regex in config.except_urls):
+                if config.except_urls and config.except_urls.search(anchor_tag['href']):
                     continue
-                anchor_tags.add(anchor_tag)
-    for anchor_tag in anchor_tags:
-        for url_regex, img_downloader in DOWNLOADERS_PER_URL_REGEX.items():
-            url_match = url_regex.match(anchor_tag['href'])
-            if url_match:
-                process_link(img_downloader, anchor_tag, url_match, config)
-                break  # no need to test other image downloaders
-        else:
-            process_link(meta_img_downloader, anchor_tag, anchor_tag['href'], config)
-    return str(soup)
+                anchor_tags[anchor_tag] = None
+    return list(anchor_tags)
+
+def find_img_downloader(url):
+    return DOWNLOADERS.find(url)
+
+@lru_cache(maxsize=None)
+def combined_regex(patterns):  # compiled only once per build, even if the same patterns are used by many pages
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
 
 def process_link(img_downloader, anchor_tag, url_match, config=PluginConfig()):
-    next_tag = anchor_tag.next_sibling
-    if next_tag and next_tag.name == 'a' and any('thumb' in _class for _class in next_tag['class']):
-        LOGGER.warning("Existing thumbnail image detected on anchor with href: %s", anchor_tag['href'])
-    thumb_filename = extract_thumb_filename(anchor_tag['href'])
-    matching_filepaths = glob(config.fs_thumbs_dir(thumb_filename + '.*'))
-    if matching_filepaths:  # => a thumbnail has already been generated
-        fs_thumb_filepath = matching_filepaths[0]
+    rel_thumb_filepath = fetch_thumbnail(img_downloader, anchor_tag['href'], url_match, config)
+    if rel_thumb_filepath:
+        insert_thumbnail(anchor_tag, rel_thumb_filepath, config)
+
+_RESOLVED_URLS_LOCK = threading.Lock()
+_RESOLVED_URLS = {}  # per (URL, thumbnails dir, thumbnail size, output path), the Future of the relative thumbnail path
+
+# Resolves every URL only once per build, even if it appears in many pages:
+# concurrent calls for the same URL wait for the first one to complete, and share its result, including None.
+def resolve_thumbnail(url, config=PluginConfig()):
+    return ASYNC_ENGINE.run(async_resolve_thumbnail(url, config))
+
+async def async_resolve_thumbnail(url, config=PluginConfig()):
+    memo_key = (url, config.fs_thumbs_dir(), config.thumb_size, config.output_path, config.content_addressed)
+    with _RESOLVED_URLS_LOCK:
+        future = _RESOLVED_URLS.get(memo_key)
+        is_owner = future is None
+        if is_owner:
+            future = _RESOLVED_URLS[memo_key] = Future()
+    if not is_owner:
+        STATS.incr('url_memo_hits')
+        return await asyncio.shield(asyncio.wrap_future(future))  # a cancellation must not be propagated to the owner of this Future
+    try:
+        img_downloader, url_match = find_img_downloader(url)
+        future.set_result(await async_fetch_thumbnail(img_downloader, url, url_match, config))
+    except BaseException as error:  # pylint: disable=broad-exception-caught
+        with _RESOLVED_URLS_LOCK:  # so that this URL can be retried
+            del _RESOLVED_URLS[memo_key]
+        future.set_exception(error)
+    return future.result()
+
+def fetch_thumbnail(img_downloader, url, url_match, config=PluginConfig()):
+    return ASYNC_ENGINE.run(async_fetch_thumbnail(img_downloader, url, url_match, config))
+
+async def async_fetch_thumbnail(img_downloader, url, url_match, config=PluginConfig()):  # pylint: disable=too-many-locals,too-many-return-statements
+    thumb_filename = url_digest(url) if config.content_addressed else extract_thumb_filename(url)
+    thumbs_index = await _async_thumbnail_index(config)
+    thumb_entry = find_thumbnail(url, config)
+    if thumb_entry:  # => a thumbnail has already been generated
+        existing_filename, _, is_none = thumb_entry
+        if is_none:  # .none file, meaning no thumbnail could be downloaded
+            STATS.incr('thumbnails_none')
+            return None
+        if not build_deadline_exceeded(config):
+            await _run_in_resize_thread(partial(generate_missing_variants, existing_filename, thumbs_index, config), config)
+        STATS.incr('thumbnails_existing')
+        return _rel_thumb_filepath(config.fs_thumbs_dir(existing_filename), config)
+    if build_deadline_exceeded(config):
+        LOGGER.info("Thumbnail does not exist for %s, but the build deadline has been exceeded => deferring its generation", thumb_filename)
+        defer_link(url, config)
+        STATS.incr('thumbnails_deferred')
+        return DEFERRED_THUMBNAIL
+    LOGGER.info("Thumbnail does not exist for %s => downloading image from %s", thumb_filename, url)
+    failure_context = SimpleNamespace(failure=None)
+    _ASYNC_FAILURE_CONTEXT.set(failure_context)  # isolated from the other links of the page, resolved concurrently in other asyncio tasks
+    try:
+        with STATS.timer(img_downloader.__name__):
+            tmp_thumb_filepath = await _run_downloader(img_downloader, url_match, config)
+    except CircuitOpenError as error:  # => no .none file is created, so that this URL is retried during the next build
+        LOGGER.warning("Skipping %s: %s", url, error)
+        STATS.incr('thumbnails_skipped')
+        return None
+    if not tmp_thumb_filepath:  # => means the downloader failed to retrieve the image in a "supported" case
+        STATS.incr('thumbnails_failed')
+        hostname = urlparse(url).netloc
+        none_filename = f'{thumb_filename}.{hostname}.none'
+        failure = failure_context.failure or {'reason': 'no_image', 'url': url}
+        LOGGER.info("Downloader could not retrieve image (%s): now creating %s", failure['reason'], none_filename)
+        none_filesize = write_none_marker(config.fs_thumbs_dir(none_filename), failure)
+        thumbs_index.add(none_filename, none_filesize, thumb_filename)
+        return None
+    STATS.incr('thumbnails_downloaded')
+    fs_thumb_filepath = await _run_in_resize_thread(partial(store_thumbnail, tmp_thumb_filepath, url, thumb_filename, thumbs_index, config), config)
+    # Under Windows, I have sometime seen a bit of delay for this operation to be performed,
+    # which could trigger a FileNotFoundError on the line below, when calling getsize()
+    thumb_filesize = os.path.getsize(fs_thumb_filepath)
+    thumbs_index.add(os.path.basename(fs_thumb_filepath), thumb_filesize, None if config.content_addressed else thumb_filename)
+    return _rel_thumb_filepath(fs_thumb_filepath, config) if thumb_filesize else None
+
+async def _run_downloader(img_downloader, url_match, config):
+    if hasattr(img_downloader, 'async_downloader'):
+        return await img_downloader.async_downloader(url_match, config)
+    # Third-party downloaders may only provide a sync API, and are then executed in threads:
+    def run_sync_downloader():
+        _FAILURE_CONTEXT.failure = None
+        return img_downloader(url_match, config), _FAILURE_CONTEXT.failure
+    out_filepath, failure = await ASYNC_ENGINE.run_in_thread(run_sync_downloader, config.max_workers, 'downloader',
+                                                             cleanup=lambda result: result[0] and os.remove(result[0]))
+    if failure:
+        _ASYNC_FAILURE_CONTEXT.get().failure = failure
+    return out_filepath
+
+# Images are resized in threads, so that the event loop keeps downloading other images meanwhile:
+async def _run_in_resize_thread(func, config):
+    return await ASYNC_ENGINE.run_in_thread(func, config.max_workers, 'resize')
+
+def store_thumbnail(tmp_thumb_filepath, url, thumb_filename, thumbs_index, config=PluginConfig()):  # returns the thumbnail file path
+    img_ext = os.path.splitext(tmp_thumb_filepath)[1]
+    # With content-addressed storage, the thumbnail is named once resized, so it is first written to a hidden file:
+    fs_thumb_filepath = config.fs_thumbs_dir(('.' if config.content_addressed else '') + thumb_filename + img_ext)
+    variants = thumbnail_variants(os.path.basename(fs_thumb_filepath), config)
+    if img_ext == '.svg':  # Pillow cannot read SVG files
+        os.replace(tmp_thumb_filepath, fs_thumb_filepath)
     else:
-        LOGGER.info("Thumbnail does not exist for %s => downloading image from %s", thumb_filename, anchor_tag['href'])
-        tmp_thumb_filepath = img_downloader(url_match, config)
-        if not tmp_thumb_filepath:  # => means the downloader failed to retrieve the image in a "supported" case
-            hostname = urlparse(anchor_tag['href']).netloc
-            none_filename = f'{thumb_filename}.{hostname}.none'
-            LOGGER.info("Downloader could not retrieve image: now creating %s", none_filename)
-            with open(config.fs_thumbs_dir(none_filename), 'w', encoding='utf8'):
-                pass
-            return
-        img_ext = os.path.splitext(tmp_thumb_filepath)[1]
-        if img_ext != '.svg':  # Pillow cannot read SVG files
-            resize_as_thumbnail(tmp_thumb_filepath, config.thumb_size)
-        fs_thumb_filepath = config.fs_thumbs_dir(thumb_filename + img_ext)
-        os.rename(tmp_thumb_filepath, fs_thumb_filepath)
-        # Under Windows, I have sometime seen a bit of delay for this operation to be performed,
-        # which could trigger a FileNotFoundError on the line below, when calling getsize()
-    if not os.path.getsize(fs_thumb_filepath):  # .none file, meaning no thumbnail could be downloaded
+        fs_variants = [(max_size, config.fs_thumbs_dir(variant_filename)) for max_size, variant_filename in variants]
+        with STATS.timer('resize_as_thumbnail'):
+            if config.resize_workers:
+                resize_in_process_pool(tmp_thumb_filepath, config.thumb_size, fs_thumb_filepath, config, fs_variants)
+            else:
+                resize_as_thumbnail(tmp_thumb_filepath, config.thumb_size, fs_thumb_filepath, fs_variants)
+        os.remove(tmp_thumb_filepath)
+    if config.content_addressed:
+        return store_content_addressed(fs_thumb_filepath, url, thumbs_index, config)
+    for _, variant_filename in variants:
+        thumbs_index.add(variant_filename, os.path.getsize(config.fs_thumbs_dir(variant_filename)))
+    return fs_thumb_filepath
+
+def _rel_thumb_filepath(fs_thumb_filepath, config):
+    return fs_thumb_filepath.replace(config.output_path + '/', '') if config.output_path else fs_thumb_filepath
+
+# Besides the main thumbnail, in the source image format & of size IMAGE_PREVIEW_THUMBNAILER_THUMB_SIZE,
+# variants can be generated in other sizes & formats. They are named {thumb_filename}.{max_size}.{ext}.
+# Returns (max_size, variant_filename) pairs.
+def thumbnail_variants(thumb_filename, config=PluginConfig()):
+    stem, img_ext = os.path.splitext(thumb_filename)
+    if img_ext == '.svg':
+        return []
+    variants = []
+    for variant_ext in [img_ext] + ['.' + img_format.lower() for img_format in config.variants_formats if _is_format_supported(img_format)]:
+        for max_size in [config.thumb_size] + list(config.variants_sizes):
+            if variant_ext != img_ext or max_size != config.thumb_size:  # => not the main thumbnail
+                variants.append((max_size, f'{stem}.{max_size}{variant_ext}'))
+    return variants
+
+# Variants missing for an existing thumbnail, e.g. after IMAGE_PREVIEW_THUMBNAILER_VARIANTS_* have been changed,
+# are generated from this thumbnail, so that no request is performed. Variants larger than it cannot be generated this way:
+# the thumbnail must be deleted in order to be downloaded again.
+def generate_missing_variants(thumb_filename, thumbs_index, config=PluginConfig()):
+    fs_variants = [(max_size, config.fs_thumbs_dir(variant_filename)) for max_size, variant_filename in thumbnail_variants(thumb_filename, config)
+                   if max_size <= config.thumb_size and not thumbs_index.has_file(variant_filename)]
+    if not fs_variants:
         return
-    rel_thumb_filepath = fs_thumb_filepath.replace(config.output_path + '/', '') if config.output_path else fs_thumb_filepath
+    LOGGER.info("Generating %s missing variants of thumbnail %s", len(fs_variants), thumb_filename)
+    try:
+        with STATS.timer('resize_as_thumbnail'):
+            resize_as_thumbnail(config.fs_thumbs_dir(thumb_filename), None, variants=fs_variants)
+    except OSError as error:  # e.g. PIL.UnidentifiedImageError
+        LOGGER.warning("Could not generate variants of thumbnail %s: %s", thumb_filename, error)
+    for _, fs_variant_filepath in fs_variants:
+        if os.path.exists(fs_variant_filepath):
+            thumbs_index.add(os.path.basename(fs_variant_filepath), os.path.getsize(fs_variant_filepath))
+
+@lru_cache(maxsize=None)
+def _is_format_supported(img_format):
+    Image.init()
+    if img_format.upper() not in Image.SAVE:
+        LOGGER.warning("Pillow cannot save images in %s format: no thumbnail variant will be generated in this format", img_format)
+        return False
+    return True
+
+# Values for the {srcset}, {srcset_<format>}, {width} & {height} placeholders in IMAGE_PREVIEW_THUMBNAILER_INSERTED_HTML.
+# {srcset} only lists images in the thumbnail own format, as <img srcset> performs no content-type negotiation:
+# variants in other formats must be listed in <picture><source type="image/..." srcset="{srcset_webp}"> tags.
+def thumbnail_srcset(rel_thumb_filepath, config=PluginConfig(), img_format=None):  # only lists the variants that exist
+    rel_thumbs_dir, thumb_filename = os.path.split(rel_thumb_filepath)
+    stem, img_ext = os.path.splitext(thumb_filename)
+    variant_ext = '.' + img_format.lower() if img_format else img_ext
+    thumbs_index = thumbnail_index(config)
+    srcset = []
+    for max_size in [config.thumb_size] + list(config.variants_sizes):
+        filename = f'{stem}.{max_size}{variant_ext}'
+        if max_size == config.thumb_size and variant_ext == img_ext:  # the thumbnail itself
+            filename = thumb_filename
+        if img_ext != '.svg' and (filename == thumb_filename or thumbs_index.has_file(filename)):
+            srcset.append(f'{os.path.join(rel_thumbs_dir, filename)} {max_size / config.thumb_size:g}x')
+    if img_format:  # an empty srcset makes browsers skip the <source> tag
+        return ', '.join(srcset)
+    return ', '.join(srcset) or rel_thumb_filepath + ' 1x'
+
+def thumbnail_dimensions(rel_thumb_filepath, config=PluginConfig()):
+    try:  # only the image header is read:
+        with Image.open(os.path.join(config.output_path, rel_thumb_filepath)) as img:
+            return img.size
+    except OSError:  # e.g. SVG files
+        return '', ''
+
+def find_thumbnail(url, config=PluginConfig()):  # returns the ThumbnailIndex entry of the thumbnail or .none file of this URL, if any
+    thumbs_index = thumbnail_index(config)
+    if config.content_addressed:
+        content_filename = thumbs_index.url_hashes.get(url)
+        return (content_filename and thumbs_index.get(os.path.splitext(content_filename)[0])) or thumbs_index.get(url_digest(url))
+    return thumbs_index.get(extract_thumb_filename(url))
+
+def url_digest(url):
+    return sha256(url.encode('utf8')).hexdigest()[:CONTENT_HASH_LENGTH]
+
+# Content-addressed thumbnails are named after a hash of their content, so that identical images are stored only once,
+# and can be cached forever by browsers & CDNs. The mapping between URLs & thumbnails is stored in URL_HASHES_FILENAME,
+# whereas .none files are named after the URL digest.
+def store_content_addressed(tmp_thumb_filepath, url, thumbs_index, config=PluginConfig()):  # returns the final thumbnail file path
+    with open(tmp_thumb_filepath, 'rb') as thumb_file:
+        content_hash = sha256(thumb_file.read()).hexdigest()[:CONTENT_HASH_LENGTH]
+    content_filename = content_hash + os.path.splitext(tmp_thumb_filepath)[1]
+    if thumbs_index.get(content_hash):
+        LOGGER.debug("Identical thumbnail already stored as %s for %s", content_filename, url)
+        STATS.incr('thumbnails_deduplicated')
+    tmp_variants = thumbnail_variants(os.path.basename(tmp_thumb_filepath), config)
+    for (_, tmp_filename), (_, filename) in zip([(None, os.path.basename(tmp_thumb_filepath))] + tmp_variants,
+                                                [(None, content_filename)] + thumbnail_variants(content_filename, config)):
+        if thumbs_index.has_file(filename):
+            os.remove(config.fs_thumbs_dir(tmp_filename))
+        else:
+            os.replace(config.fs_thumbs_dir(tmp_filename), config.fs_thumbs_dir(filename))
+            if filename != content_filename:  # the main thumbnail is added to the index by the caller
+                thumbs_index.add(filename, os.path.getsize(config.fs_thumbs_dir(filename)))
+    thumbs_index.add_url_hash(url, content_filename)
+    return config.fs_thumbs_dir(content_filename)
+
+def insert_thumbnail(anchor_tag, rel_thumb_filepath, config=PluginConfig()):
+    _warn_if_thumbnail_exists(anchor_tag)
     # Editing HTML on-the-fly to insert an <img> after the <a>:
-    new_elem_html = config.inserted_html.format(thumb=rel_thumb_filepath, link=anchor_tag['href'])
+    new_elem_html = _thumbnail_html(rel_thumb_filepath, anchor_tag['href'], config)
     anchor_tag.insert_after(BeautifulSoup(new_elem_html, config.html_parser))
 
+# Alternative to insert_thumbnail() + str(soup), that inserts the thumbnails HTML code right after the </a> closing tags in the source HTML,
+# leaving the rest of the page untouched. thumbnails is a list of (anchor_tag, rel_thumb_filepath) pairs.
+# The anchor tags are located thanks to their .sourceline & .sourcepos, that are not provided by all parsers,
+# and their closing tags by AnchorEndTagsParser: None is returned if some of them could not be located.
+def splice_thumbnails(html, thumbnails, config=PluginConfig()):
+    if not isinstance(html, str):
+        return None
+    end_tags_parser = AnchorEndTagsParser(html)
+    insertions = []
+    for anchor_tag, rel_thumb_filepath in thumbnails:
+        if anchor_tag.sourceline is None:
+            return None
+        start_offset = end_tags_parser.line_offsets[anchor_tag.sourceline - 1] + anchor_tag.sourcepos
+        if config.html_parser == 'html5lib':  # html5lib provides the position of the > ending the start tag, instead of its <
+            start_offset = end_tags_parser.anchor_start_offset_before(start_offset)
+        end_offset = end_tags_parser.anchor_end_offsets.get(start_offset)
+        if not end_offset:
+            return None
+        _warn_if_thumbnail_exists(anchor_tag)
+        # Escaping like BeautifulSoup does when serializing attributes in insert_thumbnail():
+        new_elem_html = _thumbnail_html(rel_thumb_filepath, anchor_tag['href'], config, escape=html_escape)
+        insertions.append((end_offset, new_elem_html))
+    html_chunks, prev_offset = [], 0
+    for offset, new_elem_html in sorted(insertions, key=lambda insertion: insertion[0]):
+        html_chunks.extend((html[prev_offset:offset], new_elem_html))
+        prev_offset = offset
+    html_chunks.append(html[prev_offset:])
+    return ''.join(html_chunks)
+
+# Tokenizes a whole page to map the offset of every <a> tag to the end offset of its own </a> closing tag,
+# ignoring comments & <script> contents. Anchors that are not explicitly closed,
+# e.g. implicitly closed by another <a> or by the end of their parent element, are mapped to None.
+class AnchorEndTagsParser(HTMLParser):
+    def __init__(self, html):
+        super().__init__()
+        self.html = html
+        self.line_offsets = [0] + [match.end() for match in NEWLINE_REGEX.finditer(html)]
+        self.anchor_end_offsets = {}
+        self.anchor_start_offsets = []  # in increasing order
+        self._open_tags = []  # (tag, start offset) pairs
+        self.feed(html)
+        self.close()
+    def _offset(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+        if tag == 'a':  # an <a> cannot be nested inside another one
+            for open_tag, start_offset in self._open_tags:
+                if open_tag == 'a':
+                    self.anchor_end_offsets.setdefault(start_offset, None)
+            self.anchor_start_offsets.append(self._offset())
+        self._open_tags.append((tag, self._offset()))
+    def anchor_start_offset_before(self, offset):
+        index = bisect_right(self.anchor_start_offsets, offset)
+        return self.anchor_start_offsets[index - 1] if index else None
+    def handle_endtag(self, tag):
+        if all(open_tag != tag for open_tag, _ in self._open_tags):
+            return  # stray closing tag
+        end_offset = self.html.index('>', self._offset()) + 1
+        while True:  # closing the elements still open inside this one
+            open_tag, start_offset = self._open_tags.pop()
+            if open_tag == tag:
+                if tag == 'a':
+                    self.anchor_end_offsets.setdefault(start_offset, end_offset)
+                return
+            if open_tag == 'a':
+                self.anchor_end_offsets.setdefault(start_offset, None)
+
+def _thumbnail_html(rel_thumb_filepath, link, config, escape=str):
+    if rel_thumb_filepath is DEFERRED_THUMBNAIL:
+        return config.deferred_html.format(link=escape(link))
+    placeholders = {'thumb': escape(rel_thumb_filepath), 'link': escape(link)}
+    if '{srcset}' in config.inserted_html:
+        placeholders['srcset'] = escape(thumbnail_srcset(rel_thumb_filepath, config))
+    for img_format in config.variants_formats:
+        if '{srcset_' + img_format.lower() + '}' in config.inserted_html:
+            placeholders['srcset_' + img_format.lower()] = escape(thumbnail_srcset(rel_thumb_filepath, config, img_format))
+    if '{width}' in config.inserted_html or '{height}' in config.inserted_html:
+        placeholders['width'], placeholders['height'] = thumbnail_dimensions(rel_thumb_filepath, config)
+    return config.inserted_html.format(**placeholders)
+
+def _warn_if_thumbnail_exists(anchor_tag):
+    next_tag = anchor_tag.next_sibling
+    if next_tag and next_tag.name == 'a' and any('thumb' in _class for _class in next_tag.get('class', [])):
+        LOGGER.warning("Existing thumbnail image detected on anchor with href: %s", anchor_tag['href'])
+
+# In-memory listing of a thumbnails directory, built once per build, in order to avoid a glob() call for every link.
+# It maps thumbnail filenames without extension to (filename, size, is_none) tuples.
+class ThumbnailIndex:
+    def __init__(self, fs_thumbs_dir, negative_cache_ttls=None):
+        self._entries = {}
+        self._filenames = set()
+        self._lock = threading.Lock()
+        self.stale_none_markers = {}  # per filename, the failure recorded in the .none file, once expired
+        self.url_hashes = {}  # per URL, the content-addressed thumbnail filename
+        self._url_hashes_filepath = os.path.join(fs_thumbs_dir, URL_HASHES_FILENAME)
+        if os.path.exists(self._url_hashes_filepath):
+            with open(self._url_hashes_filepath, encoding='utf8') as url_hashes_file:
+                for line in url_hashes_file:
+                    try:
+                        url, content_filename = json.loads(line)
+                    except ValueError:  # e.g. a truncated last line
+                        continue
+                    self.url_hashes[url] = content_filename
+        with os.scandir(fs_thumbs_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_file() and not dir_entry.name.startswith('.'):
+                    size = dir_entry.stat().st_size
+                    if size and dir_entry.name.endswith('.none') and negative_cache_ttls:
+                        failure = read_none_marker(dir_entry.path)
+                        if failure and is_none_marker_stale(failure, negative_cache_ttls):
+                            self.stale_none_markers[dir_entry.name] = failure
+                            continue
+                    self.add(dir_entry.name, size)
+    def add(self, filename, size, thumb_filename=None):
+        entry = (filename, size, filename.endswith('.none') or not size)
+        with self._lock:
+            self._filenames.add(filename)
+            # Like glob(thumb_filename + '.*') used to do, thumb_filename can match any file name prefix followed by a dot.
+            # This is required to match {thumb_filename}.{hostname}.none files, as hostnames contain dots.
+            for i, char in enumerate(filename):
+                if char == '.' and i > 0:
+                    self._entries.setdefault(filename[:i], entry)
+            self._entries[thumb_filename or os.path.splitext(filename)[0]] = entry
+    def get(self, thumb_filename):
+        return self._entries.get(thumb_filename)
+    def has_file(self, filename):
+        return filename in self._filenames
+    def add_url_hash(self, url, content_filename):
+        with self._lock:  # this file is only appended to, so that it is never rewritten during builds
+            self.url_hashes[url] = content_filename
+            with open(self._url_hashes_filepath, 'a', encoding='utf8') as url_hashes_file:
+                url_hashes_file.write(json.dumps([url, content_filename]) + '\n')
+
+_THUMBNAIL_INDEXES_LOCK = threading.Lock()
+_THUMBNAIL_INDEXES = {}  # per thumbnails directory
+
+def thumbnail_index(config=PluginConfig()):
+    fs_thumbs_dir = config.fs_thumbs_dir()
+    with _THUMBNAIL_INDEXES_LOCK:
+        if fs_thumbs_dir not in _THUMBNAIL_INDEXES:
+            thumbs_index = ThumbnailIndex(fs_thumbs_dir, config.negative_cache_ttls)
+            if thumbs_index.stale_none_markers:
+                revalidate_none_markers(thumbs_index, config)
+            _THUMBNAIL_INDEXES[fs_thumbs_dir] = thumbs_index
+        return _THUMBNAIL_INDEXES[fs_thumbs_dir]
+
+async def _async_thumbnail_index(config):
+    if config.fs_thumbs_dir() in _THUMBNAIL_INDEXES:
+        return thumbnail_index(config)
+    # Listing the thumbnails directory & revalidating stale .none files must not block the event loop:
+    return await _run_in_resize_thread(partial(thumbnail_index, config), config)
+
+# .none files contain the reason why no thumbnail could be generated, as JSON, and when it happened.
+# Empty .none files, produced by previous versions of this plugin, never expire.
+def write_none_marker(none_filepath, failure):
+    content = json.dumps({**failure, 'time': int(time.time())})
+    with open(none_filepath, 'w', encoding='utf8') as none_file:
+        none_file.write(content)
+    return len(content)
+
+def read_none_marker(none_filepath):
+    try:
+        with open(none_filepath, encoding='utf8') as none_file:
+            return json.load(none_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def is_none_marker_stale(failure, negative_cache_ttls):
+    ttl = negative_cache_ttls.get(failure.get('reason'), negative_cache_ttls['no_image'])
+    return ttl is not None and failure.get('time', 0) + ttl <= time.time()
+
+# Stale .none files with HTTP validators are revalidated with conditional requests:
+# when the resource has not changed, the download would fail the same way, and the .none file is kept for another TTL.
+# Other stale .none files are removed, so that their image download is attempted again.
+def revalidate_none_markers(thumbs_index, config):
+    def revalidate(none_filename):
+        failure = thumbs_index.stale_none_markers[none_filename]
+        headers = {}
+        if failure.get('etag'):
+            headers['If-None-Match'] = failure['etag']
+        if failure.get('last_modified'):
+            headers['If-Modified-Since'] = failure['last_modified']
+        if headers:
+            try:
+                if ASYNC_ENGINE.run(_async_http_status(failure['url'], config, headers=headers)) == 304:
+                    return none_filename, write_none_marker(config.fs_thumbs_dir(none_filename), failure)
+            except requests.exceptions.RequestException as error:
+                LOGGER.debug("Could not revalidate %s: %s", none_filename, error)
+        os.remove(config.fs_thumbs_dir(none_filename))
+        return none_filename, None
+    with ThreadPoolExecutor(max_workers=max(config.max_workers, config.max_conns_per_host)) as executor:
+        for none_filename, none_filesize in executor.map(revalidate, list(thumbs_index.stale_none_markers)):
+            if none_filesize:
+                STATS.incr('none_markers_revalidated')
+                thumbs_index.add(none_filename, none_filesize)
+            else:
+                STATS.incr('none_markers_expired')
+    thumbs_index.stale_none_markers.clear()
+
+# Rewritten pages are cached, one file per page, along with the state of the thumbnails of their links.
+# Cache entries are only valid if the page content, the configuration and those thumbnails are unchanged.
+def load_cached_page(page_path, html, config=PluginConfig()):
+    try:
+        with open(_page_cache_filepath(page_path, config), encoding='utf8') as cache_file:
+            cache_entry = json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if cache_entry['hash'] != _page_cache_hash(html, config):
+        return None
+    if cache_entry['thumbs'] != _thumbs_state(cache_entry['thumbs'], config):
+        return None
+    if not all(cache_entry['thumbs'].values()):  # => some thumbnails could not be resolved, without any .none marker
+        return None
+    LOGGER.debug("Page cache hit for %s", page_path)
+    return cache_entry['html']
+
+def save_cached_page(page_path, html, edited_html, hrefs, config=PluginConfig()):
+    cache_filepath = _page_cache_filepath(page_path, config)
+    os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+    cache_entry = {
+        'hash': _page_cache_hash(html, config),
+        'html': edited_html,
+        'thumbs': _thumbs_state(hrefs, config),
+    }
+    tmp_fd, tmp_filepath = mkstemp(dir=os.path.dirname(cache_filepath))
+    with os.fdopen(tmp_fd, 'w', encoding='utf8') as tmp_file:
+        json.dump(cache_entry, tmp_file)
+    os.replace(tmp_filepath, cache_filepath)
+
+def _page_cache_filepath(page_path, config):
+    return os.path.join(config.cache_dir, 'pages', sha256(os.path.abspath(page_path).encode('utf8')).hexdigest() + '.json')
+
+def _page_cache_hash(html, config):
+    config_subset = {key: config[key] for key in PAGE_CACHE_CONFIG_KEYS}
+    config_json = json.dumps(config_subset, sort_keys=True, default=lambda obj: getattr(obj, 'pattern', str(obj)))
+    return sha256((PAGE_CACHE_FORMAT_VERSION + config_json + html).encode('utf8')).hexdigest()
+
+def _thumbs_state(urls, config):  # maps URLs to the existing thumbnail or .none filename, if any
+    thumbs_state = {}
+    for url in urls:
+        thumb_entry = find_thumbnail(url, config)
+        thumbs_state[url] = thumb_entry[0] if thumb_entry else None
+    return thumbs_state
+
+# Once IMAGE_PREVIEW_THUMBNAILER_BUILD_DEADLINE is exceeded, no more images are downloaded during the build:
+# links without thumbnails are stored in a pending links list, and can be processed later with --drain-pending.
+DEFERRED_THUMBNAIL = object()  # returned by fetch_thumbnail() for links that have been deferred
+
+_BUILD_START_TIME_LOCK = threading.Lock()
+_BUILD_START_TIME = None
+_PENDING_LINKS_LOCK = threading.Lock()
+_PENDING_LINKS = {}  # per cache directory, per URL, the configuration required to generate its thumbnail
+
+def start_build_clock(_pelican=None):
+    global _BUILD_START_TIME  # pylint: disable=global-statement
+    with _BUILD_START_TIME_LOCK:
+        _BUILD_START_TIME = time.monotonic()
+
+def build_deadline_exceeded(config=PluginConfig()):
+    if not config.build_deadline:
+        return False
+    if _BUILD_START_TIME is None:  # => the "initialized" signal has not been received, e.g. when not running inside Pelican
+        start_build_clock()
+    return time.monotonic() - _BUILD_START_TIME > config.build_deadline
+
+def defer_link(url, config=PluginConfig()):
+    with _PENDING_LINKS_LOCK:
+        _PENDING_LINKS.setdefault(config.cache_dir, {})[url] = {key: config[key] for key in PENDING_LINKS_CONFIG_KEYS}
+
+def load_pending_links(cache_dir=DEFAULT_CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, PENDING_LINKS_FILENAME), encoding='utf8') as pending_file:
+            return json.load(pending_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+# Merges the links deferred during this build into the pending links lists, and removes from them the links that now have a thumbnail or a .none file:
+def save_pending_links():
+    with _PENDING_LINKS_LOCK:
+        for cache_dir, deferred_links in _PENDING_LINKS.items():
+            pending_links = {**load_pending_links(cache_dir), **deferred_links}
+            pending_links = {url: link_config for url, link_config in pending_links.items()
+                             if not find_thumbnail(url, PluginConfig(link_config))}
+            pending_filepath = os.path.join(cache_dir, PENDING_LINKS_FILENAME)
+            if not pending_links:
+                if os.path.exists(pending_filepath):
+                    os.remove(pending_filepath)
+                continue
+            LOGGER.warning("%s links are pending thumbnail generation: they can be processed with %s --drain-pending %s", len(pending_links), __file__, cache_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_fd, tmp_filepath = mkstemp(dir=cache_dir)
+            with os.fdopen(tmp_fd, 'w', encoding='utf8') as tmp_file:
+                json.dump(pending_links, tmp_file, indent=2)
+            os.replace(tmp_filepath, pending_filepath)
+        _PENDING_LINKS.clear()
+
+def drain_pending_links(cache_dir=DEFAULT_CACHE_DIR):
+    pending_links = load_pending_links(cache_dir)
+    LOGGER.info("%s links pending thumbnail generation in %s", len(pending_links), cache_dir)
+    for url, link_config in pending_links.items():
+        config = PluginConfig(link_config)
+        os.makedirs(config.fs_thumbs_dir(), exist_ok=True)
+        img_downloader, url_match = find_img_downloader(url)
+        fetch_thumbnail(img_downloader, url, url_match, config)
+    with _PENDING_LINKS_LOCK:
+        _PENDING_LINKS.setdefault(cache_dir, {})
+    save_pending_links()
+
+# Durations per processing stage, HTTP requests latencies per host, and various counters.
+# Durations are cumulated over all threads, and can hence exceed the build duration.
+class BuildStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+            self.hosts = defaultdict(lambda: {'requests': 0, 'seconds': 0.0, 'latency_histogram': [0] * (len(LATENCY_HISTOGRAM_BUCKETS) + 1)})
+    def incr(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.stages[stage]['calls'] += 1
+                self.stages[stage]['seconds'] += duration
+    def record_http_request(self, hostname, duration):
+        with self._lock:
+            host_stats = self.hosts[hostname]
+            host_stats['requests'] += 1
+            host_stats['seconds'] += duration
+            host_stats['latency_histogram'][bisect_left(LATENCY_HISTOGRAM_BUCKETS, duration)] += 1
+    def summary(self):
+        with self._lock:
+            summary = {
+                'counters': dict(self.counters),
+                'stages': {stage: dict(stage_stats) for stage, stage_stats in self.stages.items()},
+                'hosts': {hostname: dict(host_stats) for hostname, host_stats in self.hosts.items()},
+                'latency_histogram_buckets': [f'<={bucket}s' for bucket in LATENCY_HISTOGRAM_BUCKETS] + [f'>{LATENCY_HISTOGRAM_BUCKETS[-1]}s'],
+            }
+        for hostname, pool_stats in http_pool_stats().items():
+            if hostname in summary['hosts']:
+                summary['hosts'][hostname].update(connections_opened=pool_stats['opened'], connections_reused=pool_stats['reused'])
+        summary['tripped_hosts'] = circuit_breaker_stats()
+        return summary
+
+STATS = BuildStats()
+
+def report_build_stats(json_filepath=None):
+    summary = STATS.summary()
+    if not summary['stages']:  # => this plugin has not processed any page
+        return
+    LOGGER.info("Build stats:")
+    for stage, stage_stats in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        LOGGER.info("- %s: %.2fs (%s calls)", stage, stage_stats['seconds'], stage_stats['calls'])
+    counters = summary['counters']
+    LOGGER.info("- thumbnails: %s existing, %s .none, %s downloaded, %s failed - %.1f MiB downloaded",
+                counters.get('thumbnails_existing', 0), counters.get('thumbnails_none', 0), counters.get('thumbnails_downloaded', 0),
+                counters.get('thumbnails_failed', 0), counters.get('bytes_downloaded', 0) / 1024 / 1024)
+    if counters.get('thumbnails_deferred'):
+        LOGGER.info("- thumbnails: %s deferred, because the build deadline was exceeded", counters['thumbnails_deferred'])
+    if 'page_cache_hits' in counters or 'page_cache_misses' in counters:
+        LOGGER.info("- page cache: %s hits, %s misses", counters.get('page_cache_hits', 0), counters.get('page_cache_misses', 0))
+    for hostname, host_stats in sorted(summary['hosts'].items(), key=lambda item: -item[1]['seconds']):
+        histogram = ' '.join(f'{bucket}:{count}' for bucket, count in zip(summary['latency_histogram_buckets'], host_stats['latency_histogram']) if count)
+        LOGGER.info("- %s: %s requests, %.2fs mean latency (%s)", hostname, host_stats['requests'], host_stats['seconds'] / host_stats['requests'], histogram)
+    for hostname, breaker_stats in summary['tripped_hosts'].items():
+        LOGGER.warning("- circuit breaker tripped for %s: %s requests skipped", hostname, breaker_stats['short_circuited'])
+    if json_filepath:
+        with open(json_filepath, 'w', encoding='utf8') as json_file:
+            json.dump(summary, json_file, indent=2)
+    STATS.reset()
+
+def reset_build_caches(_pelican=None):
+    global _BUILD_START_TIME  # pylint: disable=global-statement
+    with _BUILD_START_TIME_LOCK:
+        _BUILD_START_TIME = None
+    with _THUMBNAIL_INDEXES_LOCK:
+        _THUMBNAIL_INDEXES.clear()
+    with _RESOLVED_URLS_LOCK:
+        _RESOLVED_URLS.clear()
+    with _HTTP_LOCK:
+        _CIRCUIT_BREAKERS.clear()
+    with _RESIZE_POOLS_LOCK:
+        for executor in _RESIZE_POOLS.values():
+            executor.shutdown()
+        _RESIZE_POOLS.clear()
+    ASYNC_ENGINE.close()
+    DOWNLOADERS.reset()
+
 def extract_thumb_filename(page_url):
     url_frags = page_url.split('/')
     thumb_filename = url_frags.pop()
@@ -186,35 +962,101 @@ def extract_thumb_filename(page_url):
         thumb_filename = os.path.splitext(thumb_filename)[0]
     return thumb_filename
 
-def resize_as_thumbnail(img_filepath, max_size):
-    img = Image.open(img_filepath)
-    img.thumbnail((max_size, max_size))
-    img.save(img_filepath)
+def resize_as_thumbnail(img_filepath, max_size, out_filepath=None, variants=()):
+    # When out_filepath is not provided, img_filepath is overwritten.
+    # When max_size is None, only the variants are produced.
+    # variants are (max_size, out_filepath) pairs, for additional thumbnails generated from the same decoded image,
+    # in the format matching their file extension.
+    out_filepath = out_filepath or img_filepath
+    outputs = [(max_size, out_filepath, None)] if max_size else []
+    outputs += [(size, filepath, Image.registered_extensions()[os.path.splitext(filepath)[1]]) for size, filepath in variants]
+    with Image.open(img_filepath) as img:
+        img_format = img.format
+        src_max_size = max(img.size)
+        downscale_ratio = src_max_size / max(size for size, _, _ in outputs)
+        if downscale_ratio > RESIZE_REDUCING_GAP and img_format == 'JPEG':
+            # Letting libjpeg decode the image directly at 1/2, 1/4 or 1/8 scale, while keeping it >= RESIZE_REDUCING_GAP * max_size.
+            # Contrary to what Image.thumbnail() does, the target size preserves the aspect ratio, allowing for a smaller scale:
+            img.draft('RGB' if img.mode == 'RGB' else None,
+                      (int(img.width * RESIZE_REDUCING_GAP / downscale_ratio), int(img.height * RESIZE_REDUCING_GAP / downscale_ratio)))
+        # From the largest size to the smallest, every thumbnail is produced by resizing the previous one:
+        for i, size in enumerate(sorted({size for size, _, _ in outputs}, reverse=True)):
+            # Image.thumbnail() performs a fast Image.reduce() by an integer factor before the final resampling:
+            img.thumbnail((size, size), _resampling_filter((src_max_size if i == 0 else max(img.size)) / size), reducing_gap=RESIZE_REDUCING_GAP)
+            for output_size, output_filepath, output_format in outputs:
+                if output_size == size:
+                    _save_thumbnail(img, output_filepath, output_format or img_format, **(VARIANT_SAVE_OPTIONS.get(output_format) or {}))
 
-def artstation_download_img(url_match, config=PluginConfig()):
+def _save_thumbnail(img, out_filepath, img_format, **options):
+    if img_format in ('AVIF', 'WEBP') and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    # Writing to a temporary file first, so that no partially written thumbnail can remain:
+    tmp_out_filepath = os.path.join(os.path.dirname(out_filepath), '.' + os.path.basename(out_filepath) + '.tmp')
+    img.save(tmp_out_filepath, format=img_format, **options)
+    os.replace(tmp_out_filepath, out_filepath)
+
+# Images are resized by a pool of processes, so that this CPU-bound work is not limited by the GIL.
+# The resize threads of the asyncio engine submit their images to this pool, and wait for the result:
+# as there are IMAGE_PREVIEW_THUMBNAILER_MAX_WORKERS of them, at most this number of resize workers are busy at once.
+_RESIZE_POOLS_LOCK = threading.Lock()
+_RESIZE_POOLS = {}  # per number of workers
+
+def resize_in_process_pool(img_filepath, max_size, out_filepath, config=PluginConfig(), variants=()):
+    with _RESIZE_POOLS_LOCK:
+        if config.resize_workers not in _RESIZE_POOLS:
+            if config.resize_workers > config.max_workers:
+                LOGGER.warning("IMAGE_PREVIEW_THUMBNAILER_RESIZE_WORKERS = %s but IMAGE_PREVIEW_THUMBNAILER_MAX_WORKERS = %s: only %s images can be resized at once",
+                               config.resize_workers, config.max_workers, config.max_workers)
+            # The "spawn" start method is used because forking a multi-threaded process is unsafe:
+            executor = ProcessPoolExecutor(max_workers=config.resize_workers, mp_context=multiprocessing.get_context('spawn'))
+            _RESIZE_POOLS[config.resize_workers] = executor
+        executor = _RESIZE_POOLS[config.resize_workers]
+    executor.submit(resize_as_thumbnail, img_filepath, max_size, out_filepath, variants).result()
+
+def _resampling_filter(downscale_ratio):
+    if downscale_ratio <= RESIZE_REDUCING_GAP:  # no reduction step: using the highest quality filter
+        return RESAMPLING.LANCZOS
+    if downscale_ratio <= 4 * RESIZE_REDUCING_GAP:
+        return RESAMPLING.BICUBIC
+    # The image has been heavily reduced already, and any difference with fancier filters is invisible at this scale:
+    return RESAMPLING.BILINEAR
+
+# Downloaders are coroutines, run by the asyncio engine.
+# This decorator provides their sync API, usable from any thread, while the coroutine remains available as .async_downloader
+def sync_wrapper(async_downloader):
+    @wraps(async_downloader)
+    def downloader(url_match, config=PluginConfig()):
+        return ASYNC_ENGINE.run(async_downloader(url_match, config))
+    downloader.async_downloader = async_downloader
+    return downloader
+
+@sync_wrapper
+async def artstation_download_img(url_match, config=PluginConfig()):
     artwork_url = 'https://www.artstation.com/projects/{}.json'.format(url_match.group(1))
-    resp = http_get(artwork_url, config)
+    resp = await async_http_get(artwork_url, config)
     if not resp:
         return None
     img_url = resp.json()['assets'][0]['image_url']
-    out_filepath = download_img(img_url, config)
+    out_filepath = await async_download_img(img_url, config)
     LOGGER.debug("Image downloaded from: %s", img_url)
     return out_filepath
 
-def behance_download_img(url_match, config=PluginConfig()):
+@sync_wrapper
+async def behance_download_img(url_match, config=PluginConfig()):
     # API key from https://github.com/djheru/js-behance-api
     artwork_url = 'https://www.behance.net/v2/projects/{}?api_key=NdTKNWys9AdBhxMhXnKuxgfzmqvwkg55'.format(url_match.group(1))
-    resp = http_get(artwork_url, config)
+    resp = await async_http_get(artwork_url, config)
     if not resp:
         return None
     img_url = resp.json()['project']['covers']['404']
-    out_filepath = download_img(img_url, config)
+    out_filepath = await async_download_img(img_url, config)
     LOGGER.debug("Image downloaded from: %s", img_url)
     return out_filepath
 
-def dafont_download_img(url_match, config=PluginConfig()):
+@sync_wrapper
+async def dafont_download_img(url_match, config=PluginConfig()):
     url = url_match.string
-    resp = http_get(url, config)
+    resp = await async_http_get(url, config)
     if not resp:
         return None
     soup = BeautifulSoup(resp.content, config.html_parser)
@@ -226,25 +1068,27 @@ def dafont_download_img(url_match, config=PluginConfig()):
         img_url = 'https:' + img_url
     elif not img_url.startswith('http'):
         img_url = 'https://www.dafont.com' + img_url
-    out_filepath = download_img(img_url, config)
+    out_filepath = await async_download_img(img_url, config)
     LOGGER.debug("Image downloaded from: %s", img_url)
     return out_filepath
 
-def deviantart_download_img(url_match, config=PluginConfig()):
-    img_url = _meta_img_url(url_match.string, config)
+@sync_wrapper
+async def deviantart_download_img(url_match, config=PluginConfig()):
+    img_url = await _async_meta_img_url(url_match.string, config)
     if not img_url:
         LOGGER.debug("Skipping %s: could not retrieve <meta> image", url_match.string)
         return None
     if img_url.endswith('noentrythumb-200.png'):
         LOGGER.debug("Skipping %s: probable mature content", url_match.string)
         return None
-    out_filepath = download_img(img_url, config)
+    out_filepath = await async_download_img(img_url, config)
     LOGGER.debug("Image downloaded from: %s", img_url)
     return out_filepath
 
-def wikipedia_download_img(url_match, config=PluginConfig()):
+@sync_wrapper
+async def wikipedia_download_img(url_match, config=PluginConfig()):
     url = url_match.string
-    resp = http_get(url, config)
+    resp = await async_http_get(url, config)
     if not resp:
         return None
     soup = BeautifulSoup(resp.content, config.html_parser)
@@ -254,42 +1098,44 @@ def wikipedia_download_img(url_match, config=PluginConfig()):
     img_url = anchor_tag['href']
     if img_url.startswith('//'):
         img_url = 'https:' + img_url
-    out_filepath = download_img(img_url, config)
+    out_filepath = await async_download_img(img_url, config)
     LOGGER.debug("Image downloaded from: %s", img_url)
     return out_filepath
 
-def pixabay_download_img(url_match, config=PluginConfig()):
+@sync_wrapper
+async def pixabay_download_img(url_match, config=PluginConfig()):
     api_key = os.environ.get('PIXABAY_API_KEY')
     if not api_key:
         LOGGER.warning("$PIXABAY_API_KEY not set, cannot download image from page: %s", url_match.string)
         return None
-    resp = requests.get('https://pixabay.com/api/',
-                        params={"key": api_key, "id": url_match.group(1)},
-                        timeout=config.timeout, verify=config.cert_verify,
-                        headers={'User-Agent': config.user_agent})
+    resp = await async_http_fetch('https://pixabay.com/api/', config, params={"key": api_key, "id": url_match.group(1)})
     if resp.status_code != 200:
         LOGGER.warning("pixabay.com/api response error - HTTP code: %s", resp.status_code)
+        # The API URL contains the API key, that must not end up in .none files, published along with the website:
+        _record_failure('http_error', url_match.string)
         return None
     img_url = resp.json()['hits'][0]['previewURL']
-    out_filepath = download_img(img_url, config)
+    out_filepath = await async_download_img(img_url, config)
     LOGGER.debug("Image downloaded from: %s", img_url)
     return out_filepath
 
-def freesvg_download_img(url_match, config=PluginConfig()):
+@sync_wrapper
+async def freesvg_download_img(url_match, config=PluginConfig()):
     url = url_match.string
-    resp = http_get(url, config)
+    resp = await async_http_get(url, config)
     if not resp:
         return None
     soup = BeautifulSoup(resp.content, config.html_parser)
     img = soup.select_one('.vec_veliki')
     if not img:
         raise RuntimeError('FreeSVG tag selector failed to find a .vec_veliki <img> on ' + url)
-    out_filepath = download_img('https://freesvg.org' + img['src'], config)
+    out_filepath = await async_download_img('https://freesvg.org' + img['src'], config)
     LOGGER.debug("Image downloaded from: %s", img['src'])
     return out_filepath
 
-def meta_img_downloader(url, config=PluginConfig()):
-    img_url = _meta_img_url(url, config)
+@sync_wrapper
+async def meta_img_downloader(url, config=PluginConfig()):
+    img_url = await _async_meta_img_url(url, config)
     if not img_url:
         return None
     safe_config = PluginConfig(config)  # copy
@@ -299,53 +1145,470 @@ def meta_img_downloader(url, config=PluginConfig()):
         img_urls = [img_url]
     else:  # relative URL: we join it to the current page location + the bare hostname
         parsed = urlparse(url)
-        img_urls = [urljoin(url, img_url), urljoin(f"{parsed.scheme}://{parsed.netloc}", img_url)]
-    for img_url in img_urls:
-        try:
-            out_filepath = download_img(img_url, safe_config)
+        img_urls = list(dict.fromkeys([urljoin(url, img_url), urljoin(f"{parsed.scheme}://{parsed.netloc}", img_url)]))
+    return await _race_downloads(img_urls, safe_config)
+
+# All candidate image URLs are downloaded concurrently: the first image retrieved wins, and the other downloads are cancelled
+async def _race_downloads(img_urls, config):
+    tasks = [asyncio.create_task(_download_candidate(img_url, config)) for img_url in img_urls]
+    out_filepath = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            out_filepath = await next_done
             if out_filepath:
-                LOGGER.debug("Image downloaded from: %s", img_url)
                 return out_filepath
-        except (ConnectionError, ConnectTimeout):
-            pass
-    return None
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, str) and result != out_filepath:  # a loser that completed before being cancelled
+                os.remove(result)
 
-def _meta_img_url(url, config):
-    resp = http_get(url, config)
-    if not resp:
+async def _download_candidate(img_url, config):
+    try:
+        out_filepath = await async_download_img(img_url, config)
+    except (ConnectionError, ConnectTimeout):
+        _record_failure('connection_error', img_url)
         return None
-    soup = BeautifulSoup(resp.content, config.html_parser)
+    if out_filepath:
+        LOGGER.debug("Image downloaded from: %s", img_url)
+    return out_filepath
+
+async def _async_meta_img_url(url, config):
+    if not config.meta_max_bytes:  # => parsing the whole page
+        resp = await async_http_get(url, config)
+        return resp and _parse_meta_img_url(resp.content, config)
+    async with ASYNC_ENGINE.semaphore(config):
+        resp = await _async_http_get_stream(url, config)
+        if not resp:
+            return None
+        parser = MetaImgParser()
+        read_bytes = 0
+        with resp:  # the connection is closed without reading the rest of the page
+            decoder = codecs.getincrementaldecoder(resp.encoding or DEFAULT_ENCODING)(errors='replace')
+            async for chunk in resp.iter_chunks():
+                parser.feed(decoder.decode(chunk))
+                read_bytes += len(chunk)
+                if parser.head_ended or read_bytes >= config.meta_max_bytes:
+                    break
+    LOGGER.debug("%s bytes read from %s to look for a <meta> image", read_bytes, url)
+    STATS.incr('bytes_downloaded', read_bytes)
+    return parser.meta_img_urls.get('og:image') or parser.meta_img_urls.get('twitter:image')
+
+def _parse_meta_img_url(html, config):
+    soup = BeautifulSoup(html, config.html_parser)
     meta = soup.select_one('meta[property="og:image"]') or soup.select_one('meta[property="twitter:image"]')
     return meta and meta['content']
 
-def download_img(url, config=PluginConfig()):
+# Lightweight tokenizer that extracts og:image & twitter:image <meta> tags, until the end of the <head> section:
+class MetaImgParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.meta_img_urls = {}
+        self.head_ended = False
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            if attrs.get('property') in ('og:image', 'twitter:image') and attrs.get('content'):
+                self.meta_img_urls.setdefault(attrs['property'], attrs['content'])
+        elif tag == 'body':
+            self.head_ended = True
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.head_ended = True
+
+async def async_download_img(url, config=PluginConfig()):
     if hasattr(url, 'string'):  # can initialy be either a string or a re.Match object
         url = url.string
-    resp = http_get(url, config)
-    if not resp:
+    async with ASYNC_ENGINE.semaphore(config):
+        resp = await _async_http_get_stream(url, config)
+        if not resp:
+            return None
+        with resp:
+            ext = EXT_PER_CONTENT_TYPE.get(resp.headers.get('Content-Type'))
+            if not _is_img_response(url, ext, resp, config):
+                return None
+            out_fd, out_filepath = mkstemp(ext)
+            downloaded_bytes = 0
+            try:
+                with os.fdopen(out_fd, 'bw') as out_file:
+                    async for chunk in resp.iter_chunks():
+                        downloaded_bytes += len(chunk)
+                        if config.max_download_bytes and downloaded_bytes > config.max_download_bytes:
+                            break  # Content-Length was missing or lying: aborting the download
+                        out_file.write(chunk)
+            except BaseException:  # including asyncio.CancelledError
+                os.remove(out_filepath)
+                raise
+    return _check_downloaded_img(url, out_filepath, downloaded_bytes, resp, config)
+
+def _is_img_response(url, ext, resp, config):
+    if not ext:
+        LOGGER.warning("Skipping %s: unsupported Content-Type %s", url, resp.headers.get('Content-Type'))
+        _record_failure('unsupported_content_type', url, resp)
+        return False
+    content_length = int(resp.headers.get('Content-Length') or 0)
+    if config.max_download_bytes and content_length > config.max_download_bytes:
+        LOGGER.warning("Skipping %s: image is too large (%s bytes)", url, content_length)
+        _record_failure('too_large', url, resp)
+        return False
+    return True
+
+def _check_downloaded_img(url, out_filepath, downloaded_bytes, resp, config):  # returns out_filepath, unless it has been rejected & removed
+    STATS.incr('bytes_downloaded', downloaded_bytes)
+    if config.max_download_bytes and downloaded_bytes > config.max_download_bytes:
+        LOGGER.warning("Skipping %s: image is too large (more than %s bytes)", url, config.max_download_bytes)
+        _record_failure('too_large', url, resp)
+        os.remove(out_filepath)
+        return None
+    if not out_filepath.endswith('.svg') and _is_decompression_bomb(out_filepath, config):
+        LOGGER.warning("Skipping %s: image has too many pixels", url)
+        _record_failure('decompression_bomb', url, resp)
+        os.remove(out_filepath)
         return None
-    ext = EXT_PER_CONTENT_TYPE[resp.headers['Content-Type']]
-    _, out_filepath = mkstemp(ext)
-    with open(out_filepath, 'bw') as out_file:
-        out_file.write(resp.content)
     return out_filepath
 
-def http_get(url, config=PluginConfig()):
-    with requests.get(url, timeout=config.timeout, verify=config.cert_verify,
-                           headers={'User-Agent': config.user_agent}) as response:
-        if response.status_code == 404 and config.ignore_404:
-            return None
-        if response.status_code != 200 and config.silent_http_errors:
-            LOGGER.error('%s HTTP error when fetching %s', response.status_code, url)
+def _is_decompression_bomb(img_filepath, config):
+    # Only the image header is parsed by Image.open(), the pixels are not decoded yet:
+    try:
+        with Image.open(img_filepath) as img:
+            return bool(config.max_img_pixels) and img.width * img.height > config.max_img_pixels
+    except Image.DecompressionBombError:  # raised by Pillow when above 2 * Image.MAX_IMAGE_PIXELS
+        return True
+
+_FAILURE_CONTEXT = threading.local()  # the last download failure in the current thread, stored in .none files
+# Coroutines of the asyncio engine cannot use a thread-local: they share the failure context of the sync wrapper that is waiting for them.
+_ASYNC_FAILURE_CONTEXT = contextvars.ContextVar('failure_context')
+
+def _record_failure(reason, url, response=None):
+    failure = {'reason': reason, 'url': url}
+    if response is not None:
+        if response.headers.get('ETag'):
+            failure['etag'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            failure['last_modified'] = response.headers['Last-Modified']
+    _ASYNC_FAILURE_CONTEXT.get(_FAILURE_CONTEXT).failure = failure
+
+# Returns a requests.Response with its body loaded, whatever the HTTP client used:
+async def async_http_get(url, config=PluginConfig()):
+    async with ASYNC_ENGINE.semaphore(config):
+        resp = await _async_http_get_stream(url, config)
+        if not resp:
             return None
-        if response.status_code != 200:
-            LOGGER.debug(response.text)
-        if response.status_code != 200 and b'captcha' in response.content:
-            LOGGER.warning('CAPTCHA is likely to be required by page %s', url)
-        if response.status_code != 200 and b'CloudFront' in response.content:
-            LOGGER.warning('CloudFront is blocking request %s', url)
-        response.raise_for_status()
-        return response
+        with resp:
+            content = await resp.read()
+    STATS.incr('bytes_downloaded', len(content))
+    return resp.as_requests_response(content)
+
+# Like async_http_get(), without handling HTTP errors:
+async def async_http_fetch(url, config=PluginConfig(), **kwargs):
+    async with ASYNC_ENGINE.semaphore(config):
+        with await _async_http_request(url, config, **kwargs) as resp:
+            content = await resp.read()
+    STATS.incr('bytes_downloaded', len(content))
+    return resp.as_requests_response(content)
+
+async def _async_http_status(url, config, **kwargs):  # the response body is not read
+    async with ASYNC_ENGINE.semaphore(config):
+        with await _async_http_request(url, config, **kwargs) as resp:
+            return resp.status_code
+
+# Returns a HttpResponse whose body is not loaded yet, and that the caller is responsible for closing
+async def _async_http_get_stream(url, config):
+    resp = await _async_http_request(url, config)
+    if resp.status_code != 200:
+        with resp:
+            _record_failure('http_404' if resp.status_code == 404 else 'http_error', url, resp)
+            if resp.status_code == 404 and config.ignore_404:
+                return None
+            if config.silent_http_errors:
+                LOGGER.error('%s HTTP error when fetching %s', resp.status_code, url)
+                return None
+            # Error pages are only partially read, as they are just useful for debugging:
+            error_content = await resp.read(MAX_HTTP_ERROR_CONTENT_BYTES)
+            _log_http_error_content(url, error_content, resp.encoding)
+        resp.as_requests_response(error_content).raise_for_status()
+    return resp
+
+def _log_http_error_content(url, error_content, encoding):
+    LOGGER.debug(error_content.decode(encoding or DEFAULT_ENCODING, errors='replace'))
+    if b'captcha' in error_content:
+        LOGGER.warning('CAPTCHA is likely to be required by page %s', url)
+    if b'CloudFront' in error_content:
+        LOGGER.warning('CloudFront is blocking request %s', url)
+
+async def _async_http_request(url, config, **kwargs):  # the caller is responsible for closing the returned HttpResponse
+    parsed_url = urlparse(url)
+    headers = {'User-Agent': config.user_agent, **kwargs.pop('headers', {})}
+    send_request = _aiohttp_send_request if _use_aiohttp(config) else _requests_send_request
+    attempt = 0
+    while True:
+        _check_circuit_breaker(parsed_url.hostname)
+        if attempt:
+            await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1))
+        await asyncio.sleep(_reserve_host_turn(parsed_url.netloc, config))
+        start = time.perf_counter()
+        try:
+            resp = await send_request(url, config, headers, **kwargs)
+        except (ConnectionError, Timeout) as error:
+            if isinstance(error, Timeout):
+                _record_host_outcome(parsed_url.hostname, config, failure=True)
+            if attempt < config.http_retries:
+                LOGGER.debug("Retrying %s after error: %s", url, error)
+                attempt += 1
+                continue
+            raise
+        finally:
+            STATS.record_http_request(parsed_url.hostname, time.perf_counter() - start)
+        _record_host_outcome(parsed_url.hostname, config, failure=resp.status_code in CIRCUIT_BREAKER_STATUS_CODES)
+        if resp.status_code in HTTP_RETRY_STATUS_CODES and attempt < config.http_retries:
+            LOGGER.debug("Retrying %s after HTTP %s error", url, resp.status_code)
+            resp.close()
+            attempt += 1
+            continue
+        return resp
+
+# Sending a request & reading a response body are the only parts specific to each HTTP client.
+# With requests, the blocking calls are performed in threads.
+async def _requests_send_request(url, config, headers, **kwargs):
+    # The threads pool is as large as the semaphore, as a coroutine holding it performs at most one blocking call at a time:
+    resp = await ASYNC_ENGINE.run_in_thread(partial(http_session(config).get, url, timeout=config.timeout, verify=config.cert_verify,
+                                                    headers=headers, stream=True, **kwargs),
+                                            config.async_max_concurrency, cleanup=lambda resp: resp.close())
+    encoding = resp.encoding if 'charset' in resp.headers.get('Content-Type', '') else None
+    return HttpResponse(resp.status_code, resp.headers, resp.url, encoding, reason=resp.reason,
+                        iter_chunks=partial(_requests_iter_chunks, resp, config), close=resp.close)
+
+async def _requests_iter_chunks(resp, config):
+    chunks = resp.iter_content(HTTP_CHUNK_SIZE)
+    while True:
+        chunk = await ASYNC_ENGINE.run_in_thread(partial(next, chunks, b''), config.async_max_concurrency)
+        if not chunk:
+            return
+        yield chunk
+
+# With aiohttp, connection errors & timeouts are converted into their requests counterparts,
+# including those raised while reading the response body, that requests reports as ConnectionError.
+async def _aiohttp_send_request(url, config, headers, **kwargs):
+    timeout = aiohttp.ClientTimeout(sock_connect=config.timeout, sock_read=config.timeout)
+    try:
+        resp = await ASYNC_ENGINE.aiohttp_session(config).get(url, timeout=timeout, ssl=bool(config.cert_verify), headers=headers, **kwargs)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+        raise (Timeout if isinstance(error, asyncio.TimeoutError) else ConnectionError)(f'{error!r} when fetching {url}') from error
+    return HttpResponse(resp.status, resp.headers, str(resp.url), resp.charset, reason=resp.reason,
+                        iter_chunks=partial(_aiohttp_iter_chunks, resp, url), close=resp.release)
+
+async def _aiohttp_iter_chunks(resp, url):
+    try:
+        async for chunk in resp.content.iter_chunked(HTTP_CHUNK_SIZE):
+            yield chunk
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        raise ConnectionError(f'{error!r} when reading the response from {url}') from error
+
+# Common interface of the streamed responses of both HTTP clients. As a context manager, it closes the response.
+class HttpResponse:
+    def __init__(self, status_code, headers, url, encoding, *, reason, iter_chunks, close):  # pylint: disable=too-many-arguments
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.url = url
+        self.encoding = encoding
+        self.iter_chunks = iter_chunks  # async generator function
+        self.close = close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    async def read(self, max_bytes=0):
+        content = bytearray()
+        async for chunk in self.iter_chunks():
+            content += chunk
+            if max_bytes and len(content) >= max_bytes:
+                del content[max_bytes:]
+                break
+        return bytes(content)
+
+    def as_requests_response(self, content):
+        requests_response = requests.Response()
+        requests_response.status_code = self.status_code
+        requests_response.reason = self.reason
+        requests_response.headers = requests.structures.CaseInsensitiveDict(self.headers)
+        requests_response.url = self.url
+        requests_response.encoding = self.encoding
+        requests_response._content = content  # pylint: disable=protected-access
+        return requests_response
+
+# The sync API is a thin wrapper over the async one, usable from any thread:
+def download_img(url, config=PluginConfig()):
+    return ASYNC_ENGINE.run(async_download_img(url, config))
+download_img.async_downloader = async_download_img
+
+def http_get(url, config=PluginConfig()):
+    return ASYNC_ENGINE.run(async_http_get(url, config))
+
+def http_fetch(url, config=PluginConfig(), **kwargs):
+    return ASYNC_ENGINE.run(async_http_fetch(url, config, **kwargs))
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+_CIRCUIT_BREAKERS = {}  # per hostname: consecutive failures, trips count, time until which it is open & short-circuited requests count
+
+def _check_circuit_breaker(hostname):
+    with _HTTP_LOCK:
+        breaker = _CIRCUIT_BREAKERS.get(hostname)
+        if breaker and breaker['open_until'] > time.monotonic():
+            breaker['short_circuited'] += 1
+            raise CircuitOpenError(f'too many timeouts or HTTP 403/429 errors from {hostname}: requests to this host are suspended')
+
+def _record_host_outcome(hostname, config, failure):
+    if not config.circuit_breaker_threshold:
+        return
+    with _HTTP_LOCK:
+        breaker = _CIRCUIT_BREAKERS.setdefault(hostname, {'consecutive_failures': 0, 'trips': 0, 'open_until': 0, 'short_circuited': 0})
+        if not failure:
+            breaker['consecutive_failures'] = 0
+            return
+        breaker['consecutive_failures'] += 1
+        # After a cooldown, the first request failing reopens the circuit:
+        tripped = breaker['consecutive_failures'] >= config.circuit_breaker_threshold
+        if tripped:
+            breaker['trips'] += 1
+            breaker['open_until'] = time.monotonic() + config.circuit_breaker_cooldown if config.circuit_breaker_cooldown else float('inf')
+    if tripped:
+        LOGGER.warning("%s consecutive timeouts or HTTP 403/429 errors from %s: suspending requests to this host%s", config.circuit_breaker_threshold,
+                       hostname, f" for {config.circuit_breaker_cooldown}s" if config.circuit_breaker_cooldown else " until the end of the build")
+
+def circuit_breaker_stats():  # returns, per host that tripped its circuit breaker, how many times it did & how many requests were skipped
+    with _HTTP_LOCK:
+        return {hostname: {'trips': breaker['trips'], 'short_circuited': breaker['short_circuited']}
+                for hostname, breaker in _CIRCUIT_BREAKERS.items() if breaker['trips']}
+
+_HTTP_LOCK = threading.Lock()
+_HTTP_SESSIONS = {}  # per max number of connections per host
+_NEXT_REQUEST_TIME_PER_HOST = {}
+
+# The same session is shared between all threads, in order to keep connections alive:
+def http_session(config=PluginConfig()):
+    with _HTTP_LOCK:
+        session = _HTTP_SESSIONS.get(config.max_conns_per_host)
+        if not session:
+            # With pool_block=True, threads wait for a connection to be available
+            # instead of opening more than max_conns_per_host connections to the same host:
+            adapter = HTTPAdapter(pool_connections=HTTP_POOLS_PER_SESSION, pool_maxsize=config.max_conns_per_host, pool_block=True)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _HTTP_SESSIONS[config.max_conns_per_host] = session
+        return session
+
+def _reserve_host_turn(hostname, config):  # returns how long to wait before sending the request
+    if not config.max_requests_per_second:
+        return 0
+    with _HTTP_LOCK:  # reserving the next available time slot for this host
+        now = time.monotonic()
+        request_time = max(now, _NEXT_REQUEST_TIME_PER_HOST.get(hostname, now))
+        _NEXT_REQUEST_TIME_PER_HOST[hostname] = request_time + 1 / config.max_requests_per_second
+    return request_time - now
+
+def http_pool_stats():  # returns, per host, the number of HTTP connections opened & reused
+    stats = {}
+    with _HTTP_LOCK:
+        for session in _HTTP_SESSIONS.values():
+            adapter = session.get_adapter('https://')
+            for pool_key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[pool_key]
+                host_stats = stats.setdefault(pool.host, {'opened': 0, 'reused': 0})
+                host_stats['opened'] += pool.num_connections
+                host_stats['reused'] += pool.num_requests - pool.num_connections
+    return stats
+
+def _use_aiohttp(config):
+    return config.http_client == 'aiohttp' and _is_aiohttp_available()
+
+@lru_cache(maxsize=None)
+def _is_aiohttp_available():
+    if not aiohttp:
+        LOGGER.warning("IMAGE_PREVIEW_THUMBNAILER_HTTP_CLIENT = 'aiohttp' but aiohttp is not installed: falling back to requests")
+    return bool(aiohttp)
+
+# A single event loop, running in a background thread, executes the coroutines of all the downloaders,
+# for all the links of a page at once when IMAGE_PREVIEW_THUMBNAILER_MAX_WORKERS > 1.
+# A global semaphore bounds the number of in-flight requests, in the limit of IMAGE_PREVIEW_THUMBNAILER_ASYNC_MAX_CONCURRENCY.
+# Without aiohttp, the blocking requests are delegated to a pool of threads.
+class AsyncEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        # Those are only accessed from the event loop thread:
+        self._semaphores = {}  # per max number of in-flight requests
+        self._aiohttp_sessions = {}  # per max number of connections per host
+        self._executors = {}  # per threads name & max number of threads
+    def run(self, coro):  # runs a coroutine in the event loop, from any other thread, and waits for its result
+        failure_context = SimpleNamespace(failure=None)
+        future = asyncio.run_coroutine_threadsafe(self._run_in_failure_context(coro, failure_context), self._event_loop())
+        try:
+            return future.result()
+        finally:
+            if failure_context.failure:
+                _FAILURE_CONTEXT.failure = failure_context.failure
+    @staticmethod
+    async def _run_in_failure_context(coro, failure_context):
+        _ASYNC_FAILURE_CONTEXT.set(failure_context)  # inherited by the tasks created by this coroutine
+        return await coro
+    def _event_loop(self):
+        with self._lock:
+            if not self._loop:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_forever, args=(self._loop,), name='image-preview-thumbnailer-asyncio', daemon=True).start()
+            return self._loop
+    @staticmethod
+    def _run_forever(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+        loop.close()
+    def semaphore(self, config):
+        if config.async_max_concurrency not in self._semaphores:
+            self._semaphores[config.async_max_concurrency] = asyncio.Semaphore(config.async_max_concurrency)
+        return self._semaphores[config.async_max_concurrency]
+    def aiohttp_session(self, config):
+        if config.max_conns_per_host not in self._aiohttp_sessions:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=config.max_conns_per_host)
+            self._aiohttp_sessions[config.max_conns_per_host] = aiohttp.ClientSession(connector=connector)
+        return self._aiohttp_sessions[config.max_conns_per_host]
+    async def run_in_thread(self, func, max_workers, thread_name='io', cleanup=None):  # performs a blocking call, in a pool of threads per name
+        # A blocking call cannot be interrupted: if cancelled, it keeps running in its thread, and cleanup is then called with its result.
+        executor_key = (thread_name, max_workers)
+        if executor_key not in self._executors:
+            self._executors[executor_key] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-preview-thumbnailer-' + thread_name)
+        future = self._executors[executor_key].submit(func)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if cleanup:
+                future.add_done_callback(lambda done: done.cancelled() or done.exception() or cleanup(done.result()))
+            raise
+    def close(self):  # called at the end of every build
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if not loop:
+            return
+        asyncio.run_coroutine_threadsafe(self._close_sessions(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    async def _close_sessions(self):
+        for session in self._aiohttp_sessions.values():
+            await session.close()
+        self._aiohttp_sessions.clear()
+        self._semaphores.clear()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        self._executors.clear()
+
+ASYNC_ENGINE = AsyncEngine()
 
 DOWNLOADERS_PER_URL_REGEX = {
     re.compile(r'https://www\.artstation\.com/artwork/(.+)'): artstation_download_img,
@@ -353,38 +1616,134 @@ DOWNLOADERS_PER_URL_REGEX = {
     re.compile(r'https://www\.dafont\.com/.+\.font.*'): dafont_download_img,
     re.compile(r'https://www\.deviantart\.com/.+/art/.+'): deviantart_download_img,
     re.compile(r'https://pixabay\.com/.+-(\d+)/'): pixabay_download_img,
-    re.compile(r'https://freesvg.org/[^/]+$'): freesvg_download_img,
+    re.compile(r'https://freesvg\.org/[^/]+$'): freesvg_download_img,
     re.compile(r'.+wiki(m|p)edia\.org/wiki/.+(gif|jpg|png|svg)$'): wikipedia_download_img,
     re.compile(r'.+\.(gif|jpe?g|png|svg)$'): download_img,
 }
 
+# Downloaders are indexed per hostname, when their URL regex starts with a fixed one, so that a single regex is usually tried per URL.
+# Downloaders specific to the link hostname are tried first, then generic ones, in their registration order,
+# and finally meta_img_downloader is used if none of them matched.
+# Other Python packages can provide downloaders through a DOWNLOADERS_ENTRY_POINT_GROUP entry point,
+# pointing to a {url_regex: img_downloader} dict, with the same format as DOWNLOADERS_PER_URL_REGEX.
+# This index is only built when the first URL is looked up, and rebuilt at every build by reset(),
+# so that downloaders added to DOWNLOADERS_PER_URL_REGEX after this module has been imported are taken into account.
+class DownloaderRegistry:
+    def __init__(self, downloaders_per_url_regex=None):
+        self._downloaders_per_url_regex = {} if downloaders_per_url_regex is None else downloaders_per_url_regex
+        self._registered = []  # (url_regex, img_downloader, prepend) passed to register()
+        self._entry_points_downloaders = None
+        self._index = None  # (downloaders per hostname, generic downloaders)
+        self._lock = threading.Lock()
+    def register(self, url_regex, img_downloader, prepend=False):
+        with self._lock:
+            self._registered.append((url_regex, img_downloader, prepend))
+            self._index = None
+    def reset(self):
+        with self._lock:
+            self._index = None
+    def find(self, url):
+        per_hostname, generic = self._index or self._build_index()
+        for url_regex, img_downloader in per_hostname.get(urlparse(url).hostname, []) + generic:
+            url_match = url_regex.match(url)
+            if url_match:
+                return img_downloader, url_match
+        return meta_img_downloader, url
+    def _build_index(self):
+        with self._lock:
+            if self._index:
+                return self._index
+            if self._entry_points_downloaders is None:
+                self._entry_points_downloaders = self._load_entry_points()
+            per_hostname, generic = defaultdict(list), []
+            for url_regex, img_downloader, prepend in ([(url_regex, img_downloader, False) for url_regex, img_downloader in self._downloaders_per_url_regex.items()]
+                                                       + self._registered
+                                                       # Those take precedence over the builtin downloaders:
+                                                       + [(url_regex, img_downloader, True) for url_regex, img_downloader in self._entry_points_downloaders]):
+                if isinstance(url_regex, str):
+                    url_regex = re.compile(url_regex)
+                hostname_match = URL_REGEX_HOSTNAME_REGEX.match(url_regex.pattern)
+                downloaders = per_hostname[hostname_match.group(1).replace('\\.', '.')] if hostname_match else generic
+                downloaders.insert(0 if prepend else len(downloaders), (url_regex, img_downloader))
+            self._index = (per_hostname, generic)
+            return self._index
+    @staticmethod
+    def _load_entry_points():
+        entry_points_downloaders = []
+        for entry_point in entry_points(group=DOWNLOADERS_ENTRY_POINT_GROUP):
+            try:
+                downloaders_per_url_regex = entry_point.load()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                LOGGER.error("Could not load downloaders from entry point %s: %s", entry_point.name, error)
+                continue
+            LOGGER.debug("Loading %s downloaders from entry point %s", len(downloaders_per_url_regex), entry_point.name)
+            entry_points_downloaders.extend(downloaders_per_url_regex.items())
+        return entry_points_downloaders
+
+DOWNLOADERS = DownloaderRegistry(DOWNLOADERS_PER_URL_REGEX)
+
+def finalize_build(pelican):
+    report_build_stats(pelican.settings.get('IMAGE_PREVIEW_THUMBNAILER_STATS_FILE'))
+    save_pending_links()
+    reset_build_caches()
+
 def register():
+    signals.initialized.connect(start_build_clock)
     signals.content_written.connect(process_all_links)
+    signals.finalized.connect(finalize_build)
 
 
-def main(html_filepath):
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Insert thumbnails along image links in HTML files')
+    parser.add_argument('paths', nargs='*', help='HTML files, directories containing HTML files, or glob patterns')
+    parser.add_argument('--config', help='Pelican settings file, e.g. pelicanconf.py, to read IMAGE_PREVIEW_THUMBNAILER_* settings from')
+    parser.add_argument('--workers', type=int, default=4, help='number of pages processed in parallel')
+    parser.add_argument('--prefetch', action='store_true', help='only generate thumbnails, without editing HTML files')
+    parser.add_argument('--drain-pending', metavar='CACHE_DIR', nargs='?', const='',
+                        help='generate the thumbnails deferred by builds that exceeded IMAGE_PREVIEW_THUMBNAILER_BUILD_DEADLINE')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args(argv)
     logging.basicConfig(format="%(asctime)s [%(levelname)s] %(name)s (pid:%(process)s) %(message)s",
-                        datefmt="%H:%M:%S", level=logging.DEBUG)
-    config = PluginConfig(dict(
-        selector='article ul ul, h2:nth-of-type(3) + ul, h2:nth-of-type(4) + ul',
-        except_urls='artvee.com,comicbookplus.com,pxfuel.com,deviantart.com/.+/gallery,artstation.com/[^/]+$',
-        silent_http_errors=False
-    ))
-    if html_filepath.startswith("output/"):
-        config.output_path = "output/"
-    os.makedirs(config.fs_thumbs_dir(), exist_ok=True)
-    with nullcontext() if config.cert_verify else warnings.catch_warnings():
-        if not config.cert_verify:
-            warnings.simplefilter('ignore', InsecureRequestWarning)
-        with open(html_filepath, "r+", encoding=config.encoding) as html_file:
-            edited_html = process_all_links_in_html(html_file, config)
-            html_file.seek(0)
-            html_file.truncate()
-            html_file.write(edited_html)
-    # URL = ...
-    # URL_MATCH = re.compile(...).match(URL)
-    # print(pixabay_download_img(URL_MATCH))
-    # process_link(pixabay_download_img, {'href': URL}, URL_MATCH)
+                        datefmt="%H:%M:%S", level=logging.DEBUG if args.verbose else logging.INFO)
+    settings = read_settings(args.config) if args.config else {}
+    if args.config:
+        config = PluginConfig.from_metadata({'image-preview-thumbnailer': True}, settings)
+    else:
+        config = PluginConfig(dict(
+            selector='article ul ul, h2:nth-of-type(3) + ul, h2:nth-of-type(4) + ul',
+            except_urls='artvee.com,comicbookplus.com,pxfuel.com,deviantart.com/.+/gallery,artstation.com/[^/]+$',
+            silent_http_errors=False
+        ))
+        if args.paths and args.paths[0].startswith("output/"):
+            config.output_path = "output/"
+    if args.drain_pending is not None:
+        drain_pending_links(args.drain_pending or config.cache_dir)
+    html_filepaths = list_html_files(args.paths)
+    start_build_clock()
+    start = time.perf_counter()
+    links_count = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_html_file, html_filepath, config, args.prefetch): html_filepath for html_filepath in html_filepaths}
+        for i, future in enumerate(as_completed(futures), 1):
+            page_links_count = future.result()
+            links_count += page_links_count or 0
+            elapsed = time.perf_counter() - start
+            LOGGER.info("[%s/%s] %s: %s - %.1f pages/s, %.1f links/s", i, len(html_filepaths), futures[future],
+                        'page cache hit' if page_links_count is None else f'{page_links_count} links', i / elapsed, links_count / elapsed)
+    if html_filepaths:
+        report_build_stats(settings.get('IMAGE_PREVIEW_THUMBNAILER_STATS_FILE'))
+        save_pending_links()
+    reset_build_caches()
+
+def list_html_files(paths):  # expands directories & glob patterns
+    html_filepaths = {}  # using a dict as an ordered set
+    for path in paths:
+        for matching_path in sorted(glob(path, recursive=True)) or [path]:
+            if os.path.isdir(matching_path):
+                html_filepaths.update(dict.fromkeys(sorted(glob(os.path.join(matching_path, '**', '*.html'), recursive=True))))
+            else:
+                html_filepaths[matching_path] = None
+    return list(html_filepaths)
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    main()
@@ -1,9 +1,20 @@
-import logging, os, shutil
+# pylint: disable=invalid-name,redefined-outer-name
+import asyncio, json, logging, os, re, shutil, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import ANY
 
+from bs4 import BeautifulSoup
+from PIL import Image
 import pytest
-from requests.exceptions import HTTPError
+import requests
+from requests.exceptions import ConnectionError, HTTPError  # pylint: disable=redefined-builtin
 
-from image_preview_thumbnailer import process_all_links_in_html, extract_thumb_filename, PluginConfig, LOGGER
+import image_preview_thumbnailer
+from image_preview_thumbnailer import (process_all_links, process_all_links_in_html, download_img, drain_pending_links, extract_thumb_filename,
+                                       find_img_downloader, http_get, http_pool_stats, load_pending_links, main, read_none_marker, report_build_stats, reset_build_caches,
+                                       resize_as_thumbnail, save_pending_links, select_anchor_tags, start_build_clock, write_none_marker,
+                                       DownloaderRegistry, PluginConfig, ASYNC_ENGINE, LOGGER, STATS)
 
 
 BLOG_PAGE_TEMPLATE = """<html lang="en-US">
@@ -18,16 +29,474 @@ BLOG_PAGE_TEMPLATE = """<html lang="en-US">
 </html>"""
 
 
+class LocalImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # enables keep-alive
+    flaky_paths_requested = set()
+    def do_GET(self):
+        for error_code in (403, 404):
+            if self.path.startswith(f'/{error_code}/'):
+                self.send_response(error_code)
+                self.send_header('Content-Length', '10')
+                self.end_headers()
+                self.wfile.write(b'CloudFront')
+                return
+        if self.path.startswith('/flaky/') and self.path not in self.flaky_paths_requested:
+            self.flaky_paths_requested.add(self.path)
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.endswith('.html'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            img_path = '/stalled/unicorn.jpg' if self.path.startswith('/stalled/') else '/unicorn.jpg'
+            self.wfile.write(f'<html><head><meta property="twitter:image" content="/twitter.jpg"><meta property="og:image" content="{img_path}"></head><body>'.encode())
+            try:
+                for _ in range(1000):
+                    self.wfile.write(b'<p>Lorem ipsum</p>' * 100)
+            except (BrokenPipeError, ConnectionResetError):  # expected, as the client closes the connection after </head>
+                pass
+            return
+        if self.path.startswith('/slow/'):
+            time.sleep(.5)
+        if self.headers.get('If-None-Match') == '"unicorn"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with open('test_content/LadyofHats_DnD_Unicorn.jpg', 'rb') as img_file:
+            body = img_file.read()
+        if self.path.startswith('/stalled/'):  # the server stops sending the image midway
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body[:1024])
+            self.wfile.flush()
+            time.sleep(2)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('ETag', '"unicorn"')
+        if self.path.startswith('/no-content-length/'):
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+@pytest.fixture
+def local_server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
 def setup_function():
     logging.root.setLevel(logging.DEBUG)
     LOGGER.disable_filter()  # disabling LimitFilter log deduping from pelican.log.FatalLogger
     thumbs_dir = PluginConfig().fs_thumbs_dir()
     shutil.rmtree(thumbs_dir, ignore_errors=True)
     os.makedirs(thumbs_dir)
+    reset_build_caches()
+    STATS.reset()
 
 def test_extract_thumb_filename():
     assert extract_thumb_filename('https://pixabay.com/fr/vectors/femme-t%C3%A9l%C3%A9phone-portable-5716875/') == 'femme-téléphone-portable-5716875'
 
+def test_find_img_downloader(monkeypatch):
+    def custom_download_img(_url_match, _config):
+        return None
+    class EntryPoint:
+        name = 'custom'
+        @staticmethod
+        def load():
+            return {r'https://www\.artstation\.com/custom/(.+)': custom_download_img}
+    monkeypatch.setattr(image_preview_thumbnailer, 'entry_points', lambda group: [EntryPoint])
+    registry = DownloaderRegistry(image_preview_thumbnailer.DOWNLOADERS_PER_URL_REGEX)
+    assert registry.find('https://www.artstation.com/artwork/123')[0] is image_preview_thumbnailer.artstation_download_img
+    assert registry.find('https://www.artstation.com/custom/123')[0] is custom_download_img
+    assert registry.find('https://www.artstation.com/custom/123.jpg')[0] is custom_download_img
+    assert registry.find('https://commons.wikimedia.org/wiki/File:Unicorn.png')[0] is image_preview_thumbnailer.wikipedia_download_img
+    assert registry.find('https://example.com/unicorn.jpg')[0] is download_img
+    assert registry.find('https://example.com/unicorn.html') == (image_preview_thumbnailer.meta_img_downloader, 'https://example.com/unicorn.html')
+
+def test_downloaders_added_after_import(monkeypatch):
+    def custom_download_img(_url_match, _config):
+        return None
+    assert find_img_downloader('https://example.com/custom/123.jpg')[0] is download_img
+    monkeypatch.setitem(image_preview_thumbnailer.DOWNLOADERS_PER_URL_REGEX, re.compile(r'https://example\.com/custom/(.+)'), custom_download_img)
+    reset_build_caches()  # => new build
+    assert find_img_downloader('https://example.com/custom/123.jpg')[0] is custom_download_img
+    assert find_img_downloader('https://example.com/unicorn.jpg')[0] is download_img
+
+def test_except_urls():
+    config = PluginConfig({'except_urls': r'example\.com/a,example\.com/b'})
+    assert config.except_urls is PluginConfig({'except_urls': r'example\.com/a,example\.com/b'}).except_urls
+    page = '<html><body>' + ''.join(f'<a href="https://example.com/{c}.jpg">{c}</a>' for c in 'abc') + '</body></html>'
+    assert [anchor_tag['href'] for anchor_tag in select_anchor_tags(BeautifulSoup(page, 'html.parser'), config)] == ['https://example.com/c.jpg']
+
+def test_max_workers_preserves_links_order():
+    page = BLOG_PAGE_TEMPLATE.replace('</body>', ''.join(f'<a href="https://example.com/img{i}.png">{i}</a>' for i in range(8)) + '</body>')
+    for i in range(9):
+        with open(f'thumbnails/img{i}.png', 'wb') as thumb_file:
+            thumb_file.write(b'dummy')
+    out_html = process_all_links_in_html(page.format(illustration_url='https://example.com/img8.png'), PluginConfig({'max_workers': 4}))
+    assert out_html == process_all_links_in_html(page.format(illustration_url='https://example.com/img8.png'))
+    assert [int(src[len('thumbnails/img'):-len('.png')]) for src in re.findall(r'src="([^"]+)"', out_html)] == [8] + list(range(8))
+
+def test_links_are_resolved_concurrently(local_server_url):
+    page = BLOG_PAGE_TEMPLATE.replace('</body>', ''.join(f'<a href="{local_server_url}/slow/img{i}.jpg">{i}</a>' for i in range(7)) + '</body>')
+    start = time.perf_counter()
+    out_html = process_all_links_in_html(page.format(illustration_url=local_server_url + '/slow/img7.jpg'), PluginConfig({'max_workers': 2}))
+    assert out_html.count('<img') == 8
+    # With 2 threads downloading images, this would take at least 2 seconds:
+    assert time.perf_counter() - start < 1.5
+
+def test_existing_thumbnails_are_not_downloaded_again():
+    for filename in ('dnd.jpg', 'mirage-gothic.font.png', 'Angel-maybe-697980132.www.deviantart.com.none'):
+        with open('thumbnails/' + filename, 'wb') as thumb_file:
+            if not filename.endswith('.none'):
+                thumb_file.write(b'dummy')
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url='https://example.com/dnd.jpg'))
+    assert 'src="thumbnails/dnd.jpg"' in out_html
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url='https://www.dafont.com/mirage-gothic.font?l[]=10&l[]=1'))
+    assert 'src="thumbnails/mirage-gothic.font.png"' in out_html
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url='https://www.deviantart.com/eggboy122/art/Angel-maybe-697980132'))
+    assert '<img' not in out_html
+
+def test_splice_html_rewriter():
+    page = """<html><body>
+<p class='intro'>Some  <b>untouched</b> markup&nbsp;&amp; entities<br>
+  <A HREF="https://example.com/dnd.jpg?a=1&amp;b=2" >DnD</A > and <a href="https://example.com/none.jpg">none</a>
+  <a href="https://example.com/dnd.jpg">a</a></p>
+</body></html>"""
+    with open('thumbnails/dnd.jpg', 'wb') as thumb_file:
+        thumb_file.write(b'dummy')
+    with open('thumbnails/none.example.com.none', 'wb'):
+        pass
+    expected_html = page.replace('DnD</A >', 'DnD</A ><img src="thumbnails/dnd.jpg" data-link="https://example.com/dnd.jpg?a=1&amp;b=2">')\
+                        .replace('>a</a>', '>a</a><img src="thumbnails/dnd.jpg" data-link="https://example.com/dnd.jpg">')
+    config = PluginConfig({'html_rewriter': 'splice', 'inserted_html': '<img src="{thumb}" data-link="{link}">'})
+    assert process_all_links_in_html(page, config) == expected_html
+    pytest.importorskip('html5lib')
+    config.html_parser = 'html5lib'
+    assert process_all_links_in_html(page, config) == expected_html
+
+def test_splice_html_rewriter_locates_anchors_own_end_tags():
+    for filename in ('a.jpg', 'b.jpg'):
+        with open('thumbnails/' + filename, 'wb') as thumb_file:
+            thumb_file.write(b'dummy')
+    config = PluginConfig({'html_rewriter': 'splice', 'inserted_html': '<img src="{thumb}">'})
+    page = '<html><body><a href="https://example.com/a.jpg">A <!-- </a> --><script>"</a>"</script> x</a></body></html>'
+    assert process_all_links_in_html(page, config) == page.replace(' x</a>', ' x</a><img src="thumbnails/a.jpg">')
+    # Unclosed anchors cannot be spliced, and BeautifulSoup serialization is used instead:
+    page = '<html><body><a href="https://example.com/a.jpg">A<p><a href="https://example.com/b.jpg">B</a></p></body></html>'
+    assert process_all_links_in_html(page, config) == process_all_links_in_html(page, PluginConfig({'inserted_html': '<img src="{thumb}">'}))
+
+def test_page_cache(tmp_path, monkeypatch):
+    page_path = tmp_path / 'page.html'
+    page_html = BLOG_PAGE_TEMPLATE.format(illustration_url='https://example.com/dnd.jpg')
+    (tmp_path / 'thumbnails').mkdir()
+    (tmp_path / 'thumbnails' / 'dnd.jpg').write_bytes(b'dummy')
+    context = {'page': type('Page', (), {'metadata': {}}), 'OUTPUT_PATH': str(tmp_path), 'CACHE_PATH': str(tmp_path / 'cache'),
+               'IMAGE_PREVIEW_THUMBNAILER': True, 'IMAGE_PREVIEW_THUMBNAILER_PAGE_CACHE': True}
+    page_path.write_text(page_html)
+    process_all_links(page_path, context)
+    out_html = page_path.read_text()
+    assert 'src="thumbnails/dnd.jpg"' in out_html
+    # Now the HTML must not be parsed anymore:
+    def fail(*_):
+        raise AssertionError('Page cache should have been used')
+    with monkeypatch.context() as patch:
+        patch.setattr(image_preview_thumbnailer, '_process_all_links_in_html', fail)
+        page_path.write_text(page_html)
+        process_all_links(page_path, context)
+        assert page_path.read_text() == out_html
+        # Any change in the page content invalidates the cache:
+        page_path.write_text(page_html.replace('Dummy', 'Updated'))
+        with pytest.raises(AssertionError):
+            process_all_links(page_path, context)
+    # The same goes for changes in the thumbnails:
+    (tmp_path / 'thumbnails' / 'dnd.jpg').rename(tmp_path / 'thumbnails' / 'dnd.png')
+    reset_build_caches()
+    page_path.write_text(page_html)
+    process_all_links(page_path, context)
+    assert 'src="thumbnails/dnd.png"' in page_path.read_text()
+
+def test_resize_as_thumbnail():
+    resize_as_thumbnail('test_content/LadyofHats_DnD_Unicorn.jpg', 100, 'thumbnails/unicorn.jpg')
+    with Image.open('thumbnails/unicorn.jpg') as img:
+        assert img.format == 'JPEG'
+        assert max(img.size) == 100
+    assert os.listdir('thumbnails') == ['unicorn.jpg']
+
+def test_http_connections_reuse(local_server_url):
+    for _ in range(3):
+        assert http_get(local_server_url + '/img.jpg').headers['Content-Type'] == 'image/jpeg'
+    assert http_pool_stats()['127.0.0.1']['reused'] >= 2
+
+def test_download_img_max_bytes(local_server_url):
+    config = PluginConfig({'max_download_bytes': 1024})
+    assert download_img(local_server_url + '/unicorn.jpg', config) is None
+    assert download_img(local_server_url + '/no-content-length/unicorn.jpg', config) is None
+    out_filepath = download_img(local_server_url + '/no-content-length/unicorn.jpg')
+    assert os.path.getsize(out_filepath) == os.path.getsize('test_content/LadyofHats_DnD_Unicorn.jpg')
+    os.remove(out_filepath)
+
+def test_http_error_not_silent(local_server_url, caplog):
+    with pytest.raises(HTTPError) as exc_info:
+        download_img(local_server_url + '/404/unicorn.jpg', PluginConfig({'silent_http_errors': False}))
+    assert exc_info.value.response.status_code == 404
+    assert 'CloudFront is blocking request' in caplog.text
+    assert download_img(local_server_url + '/404/unicorn.jpg') is None
+
+def test_meta_img_in_head(local_server_url):
+    url = local_server_url + '/gallery/artwork.html'
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url))
+    assert 'src="thumbnails/artwork.html.jpg"' in out_html
+    assert os.listdir('thumbnails') == ['artwork.html.jpg']
+    # The page weighs 1.8MB, but only its <head> should have been read, in a single chunk, before downloading the image:
+    img_size = os.path.getsize('test_content/LadyofHats_DnD_Unicorn.jpg')
+    assert STATS.summary()['counters']['bytes_downloaded'] <= img_size + image_preview_thumbnailer.HTTP_CHUNK_SIZE
+
+def test_meta_img_candidates_race(monkeypatch):
+    cancelled_urls = []
+    async def fake_async_download_img(url, _config):
+        try:
+            await asyncio.sleep(10 if 'slow' in url else 0)
+        except asyncio.CancelledError:
+            cancelled_urls.append(url)
+            raise
+        return None if 'none' in url else url + '.jpg'
+    monkeypatch.setattr(image_preview_thumbnailer, 'async_download_img', fake_async_download_img)
+    race_downloads = image_preview_thumbnailer._race_downloads  # pylint: disable=protected-access
+    start = time.perf_counter()
+    assert ASYNC_ENGINE.run(race_downloads(['https://slow', 'https://none', 'https://fast'], PluginConfig())) == 'https://fast.jpg'
+    assert time.perf_counter() - start < 5
+    assert cancelled_urls == ['https://slow']
+    assert ASYNC_ENGINE.run(race_downloads(['https://none'], PluginConfig())) is None
+
+def test_pixabay_api_key_is_not_recorded(monkeypatch):
+    async def fake_async_http_fetch(url, _config, params):
+        resp = requests.Response()
+        resp.status_code = 403
+        resp.url = f'{url}?key={params["key"]}&id={params["id"]}'
+        return resp
+    monkeypatch.setenv('PIXABAY_API_KEY', 'secret')
+    monkeypatch.setattr(image_preview_thumbnailer, 'async_http_fetch', fake_async_http_fetch)
+    url = 'https://pixabay.com/fr/vectors/femme-5716875/'
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url))
+    assert '<img' not in out_html
+    none_filename, = os.listdir('thumbnails')
+    assert read_none_marker('thumbnails/' + none_filename) == {'reason': 'http_error', 'url': url, 'time': ANY}
+    with open('thumbnails/' + none_filename, encoding='utf8') as none_file:
+        assert 'key=' not in none_file.read()
+
+def test_downloader_failure_is_recorded(local_server_url):
+    def fetch_from_worker_thread():
+        image_preview_thumbnailer._FAILURE_CONTEXT.failure = None  # pylint: disable=protected-access
+        assert image_preview_thumbnailer.meta_img_downloader(local_server_url + '/404/artwork.html') is None
+        return image_preview_thumbnailer._FAILURE_CONTEXT.failure  # pylint: disable=protected-access
+    with ThreadPoolExecutor() as executor:
+        assert executor.submit(fetch_from_worker_thread).result()['reason'] == 'http_404'
+
+def test_aiohttp_http_client(local_server_url):
+    pytest.importorskip('aiohttp')
+    config = PluginConfig({'http_client': 'aiohttp'})
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=local_server_url + '/gallery/artwork.html'), config)
+    assert 'src="thumbnails/artwork.html.jpg"' in out_html
+    assert download_img(local_server_url + '/404/unicorn.jpg', config) is None
+    assert image_preview_thumbnailer._FAILURE_CONTEXT.failure['reason'] == 'http_404'  # pylint: disable=protected-access
+    with pytest.raises(HTTPError):
+        download_img(local_server_url + '/404/unicorn.jpg', PluginConfig({'http_client': 'aiohttp', 'silent_http_errors': False}))
+    assert STATS.summary()['hosts']['127.0.0.1']['requests'] == 4
+
+def test_stalled_response_body(local_server_url):
+    http_clients = ['requests', 'aiohttp'] if image_preview_thumbnailer.aiohttp else ['requests']
+    for http_client in http_clients:
+        config = PluginConfig({'http_client': http_client, 'timeout': 1})
+        with pytest.raises(ConnectionError):
+            download_img(local_server_url + '/stalled/unicorn.jpg', config)
+        assert image_preview_thumbnailer.meta_img_downloader(local_server_url + '/stalled/artwork.html', config) is None
+
+def test_resize_workers(local_server_url):
+    page = BLOG_PAGE_TEMPLATE.replace('</body>', ''.join(f'<a href="{local_server_url}/img{i}.jpg">{i}</a>' for i in range(4)) + '</body>')
+    out_html = process_all_links_in_html(page.format(illustration_url=local_server_url + '/unicorn.jpg'), PluginConfig({'max_workers': 4, 'resize_workers': 2}))
+    assert len(re.findall('<img', out_html)) == 5
+    for thumb_filename in os.listdir('thumbnails'):
+        with Image.open('thumbnails/' + thumb_filename) as img:
+            assert max(img.size) == 300
+
+def test_resize_workers_per_cpu_core():
+    assert PluginConfig({'resize_workers': True}).resize_workers == os.cpu_count()
+    assert PluginConfig.from_metadata({}, {'IMAGE_PREVIEW_THUMBNAILER': True, 'IMAGE_PREVIEW_THUMBNAILER_RESIZE_WORKERS': True}).resize_workers == os.cpu_count()
+
+def test_decompression_bomb_is_skipped(local_server_url):
+    url = local_server_url + '/unicorn.jpg'
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url), PluginConfig({'max_img_pixels': 1000 * 1000}))
+    assert '<img' not in out_html
+    none_filename = 'unicorn.{}.none'.format(local_server_url.split('/')[-1])
+    assert os.listdir('thumbnails') == [none_filename]
+    assert read_none_marker('thumbnails/' + none_filename) == {'reason': 'decompression_bomb', 'url': url, 'etag': '"unicorn"', 'time': ANY}
+
+def test_stale_none_markers_are_revalidated(local_server_url):
+    url = local_server_url + '/unicorn.jpg'
+    none_filename = 'unicorn.{}.none'.format(local_server_url.split('/')[-1])
+    write_none_marker('thumbnails/' + none_filename, {'reason': 'too_large', 'url': url, 'etag': '"unicorn"'})
+    config = PluginConfig({'negative_cache_ttls': {'too_large': 0}})
+    assert '<img' not in process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url), config)
+    assert STATS.summary()['counters']['none_markers_revalidated'] == 1
+    assert os.listdir('thumbnails') == [none_filename]
+
+def test_stale_none_markers_are_removed(local_server_url):
+    url = local_server_url + '/unicorn.jpg'
+    with open('thumbnails/legacy.example.com.none', 'w', encoding='utf8'):
+        pass  # empty .none files never expire
+    write_none_marker('thumbnails/unicorn.{}.none'.format(local_server_url.split('/')[-1]), {'reason': 'http_404', 'url': url})
+    config = PluginConfig({'negative_cache_ttls': {'http_404': 0}})
+    assert '<img' in process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url), config)
+    assert STATS.summary()['counters']['none_markers_expired'] == 1
+    assert sorted(os.listdir('thumbnails')) == ['legacy.example.com.none', 'unicorn.jpg']
+
+def test_urls_are_resolved_once_per_build(local_server_url):
+    url = local_server_url + '/404/unicorn.jpg'
+    pages = [BLOG_PAGE_TEMPLATE.format(illustration_url=url) for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        out_htmls = list(executor.map(lambda page: process_all_links_in_html(page, PluginConfig({'ignore_404': True})), pages))
+    assert not any('<img' in out_html for out_html in out_htmls)
+    assert STATS.summary()['hosts']['127.0.0.1']['requests'] == 1
+    assert STATS.summary()['counters']['url_memo_hits'] == 7
+
+def test_circuit_breaker(local_server_url):
+    page = BLOG_PAGE_TEMPLATE.replace('</body>', ''.join(f'<a href="{local_server_url}/403/img{i}.jpg">{i}</a>' for i in range(5)) + '</body>')
+    out_html = process_all_links_in_html(page.format(illustration_url=local_server_url + '/403/unicorn.jpg'), PluginConfig({'circuit_breaker_threshold': 2}))
+    assert '<img' not in out_html
+    assert len(os.listdir('thumbnails')) == 2  # no .none file is created for the links skipped
+    stats = STATS.summary()
+    assert stats['hosts']['127.0.0.1']['requests'] == 2
+    assert stats['tripped_hosts'] == {'127.0.0.1': {'trips': 1, 'short_circuited': 4}}
+
+def test_http_retries(local_server_url, monkeypatch):
+    monkeypatch.setattr(image_preview_thumbnailer, 'HTTP_RETRY_BACKOFF', 0)
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=local_server_url + '/flaky/unicorn.jpg'), PluginConfig({'http_retries': 1}))
+    assert '<img' in out_html
+    assert STATS.summary()['hosts']['127.0.0.1']['requests'] == 2
+
+def test_build_deadline(local_server_url, tmp_path):
+    url = local_server_url + '/unicorn.jpg'
+    config = PluginConfig({'build_deadline': 0.01, 'cache_dir': str(tmp_path), 'deferred_html': '<span class="pending" data-link="{link}"></span>'})
+    start_build_clock()
+    time.sleep(0.02)
+    out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url), config)
+    assert f'<span class="pending" data-link="{url}"></span>' in out_html
+    assert not os.listdir('thumbnails')
+    save_pending_links()
+    assert list(load_pending_links(str(tmp_path))) == [url]
+    reset_build_caches()
+    drain_pending_links(str(tmp_path))
+    assert os.listdir('thumbnails') == ['unicorn.jpg']
+    assert not os.listdir(tmp_path)
+
+def test_batch_cli(local_server_url, tmp_path):
+    output_dir = tmp_path / 'output'
+    (output_dir / 'pages').mkdir(parents=True)
+    for i in range(3):
+        (output_dir / 'pages' / f'page{i}.html').write_text(BLOG_PAGE_TEMPLATE.format(illustration_url=f'{local_server_url}/img{i}.jpg'))
+    (tmp_path / 'pelicanconf.py').write_text(f'OUTPUT_PATH = {str(output_dir)!r}\nCACHE_PATH = {str(tmp_path / "cache")!r}\n')
+    main(['--config', str(tmp_path / 'pelicanconf.py'), '--prefetch', str(output_dir)])
+    assert sorted(os.listdir(output_dir / 'thumbnails')) == ['img0.jpg', 'img1.jpg', 'img2.jpg']
+    assert '<img' not in (output_dir / 'pages' / 'page0.html').read_text()
+    main(['--config', str(tmp_path / 'pelicanconf.py'), str(output_dir / 'pages' / '*.html')])
+    assert 'src="thumbnails/img0.jpg"' in (output_dir / 'pages' / 'page0.html').read_text()
+
+def test_content_addressed_storage(local_server_url):
+    page = BLOG_PAGE_TEMPLATE.replace('</body>', f'<a href="{local_server_url}/mirror/unicorn.jpg">mirror</a></body>')
+    page = page.format(illustration_url=local_server_url + '/unicorn.jpg')
+    out_html = process_all_links_in_html(page, PluginConfig({'content_addressed': True}))
+    thumb_filenames = [filename for filename in os.listdir('thumbnails') if not filename.startswith('.')]
+    assert len(thumb_filenames) == 1
+    assert re.fullmatch('[0-9a-f]{32}.jpg', thumb_filenames[0])
+    assert out_html.count(f'src="thumbnails/{thumb_filenames[0]}"') == 2
+    assert STATS.summary()['counters']['thumbnails_deduplicated'] == 1
+    reset_build_caches()  # => new build
+    assert process_all_links_in_html(page, PluginConfig({'content_addressed': True})) == out_html
+    assert STATS.summary()['counters']['thumbnails_existing'] == 2
+
+def test_thumbnail_variants(local_server_url):
+    page = BLOG_PAGE_TEMPLATE.format(illustration_url=local_server_url + '/unicorn.jpg')
+    config = PluginConfig({'variants_sizes': [600], 'variants_formats': ['WEBP'],
+                           'inserted_html': '<picture><source type="image/webp" srcset="{srcset_webp}">'
+                                            '<img src="{thumb}" srcset="{srcset}" width="{width}" height="{height}"></picture>'})
+    out_html = process_all_links_in_html(page, config)
+    assert sorted(os.listdir('thumbnails')) == ['unicorn.300.webp', 'unicorn.600.jpg', 'unicorn.600.webp', 'unicorn.jpg']
+    with Image.open('thumbnails/unicorn.600.webp') as img:
+        assert img.format == 'WEBP'
+        assert max(img.size) == 600
+    with Image.open('thumbnails/unicorn.jpg') as img:
+        width, height = img.size
+    assert '<source srcset="thumbnails/unicorn.300.webp 1x, thumbnails/unicorn.600.webp 2x" type="image/webp"/>' in out_html
+    assert 'src="thumbnails/unicorn.jpg" srcset="thumbnails/unicorn.jpg 1x, thumbnails/unicorn.600.jpg 2x"' in out_html
+    assert f'width="{width}"' in out_html and f'height="{height}"' in out_html
+    # Missing variants are generated during the next build, from the existing thumbnail, except the ones larger than it:
+    os.remove('thumbnails/unicorn.300.webp')
+    os.remove('thumbnails/unicorn.600.webp')
+    reset_build_caches()  # => new build
+    STATS.reset()
+    out_html = process_all_links_in_html(page, config)
+    assert '<source srcset="thumbnails/unicorn.300.webp 1x" type="image/webp"/>' in out_html
+    assert 'src="thumbnails/unicorn.jpg" srcset="thumbnails/unicorn.jpg 1x, thumbnails/unicorn.600.jpg 2x"' in out_html
+    assert STATS.summary()['counters']['thumbnails_existing'] == 1
+    assert 'thumbnails_downloaded' not in STATS.summary()['counters']
+    with Image.open('thumbnails/unicorn.300.webp') as img:
+        assert img.format == 'WEBP'
+
+def test_thumbnail_variants_of_existing_thumbnail_require_no_request():
+    shutil.copy('test_content/LadyofHats_DnD_Unicorn.jpg', 'thumbnails/unicorn.jpg')
+    page = BLOG_PAGE_TEMPLATE.format(illustration_url='http://127.0.0.1:1/unicorn.jpg')  # unreachable host
+    out_html = process_all_links_in_html(page, PluginConfig({'variants_sizes': [150, 600], 'variants_formats': ['WEBP']}))
+    assert 'src="thumbnails/unicorn.jpg"' in out_html
+    assert sorted(os.listdir('thumbnails')) == ['unicorn.150.jpg', 'unicorn.150.webp', 'unicorn.300.webp', 'unicorn.jpg']
+    assert not STATS.summary()['hosts']
+
+def test_thumbnail_srcset_only_lists_existing_variants():
+    config = PluginConfig({'variants_sizes': [600], 'variants_formats': ['WEBP']})
+    for filename in ('unicorn.jpg', 'unicorn.600.jpg'):
+        with open('thumbnails/' + filename, 'wb') as thumb_file:
+            thumb_file.write(b'dummy')
+    assert image_preview_thumbnailer.thumbnail_srcset('thumbnails/unicorn.jpg', config) == 'thumbnails/unicorn.jpg 1x, thumbnails/unicorn.600.jpg 2x'
+    assert image_preview_thumbnailer.thumbnail_srcset('thumbnails/dnd.jpg', config) == 'thumbnails/dnd.jpg 1x'
+    assert image_preview_thumbnailer.thumbnail_srcset('thumbnails/unicorn.jpg', config, 'WEBP') == ''
+    with open('thumbnails/unicorn.600.webp', 'wb') as thumb_file:
+        thumb_file.write(b'dummy')
+    reset_build_caches()  # => the thumbnails index is rebuilt
+    assert image_preview_thumbnailer.thumbnail_srcset('thumbnails/unicorn.jpg', config, 'WEBP') == 'thumbnails/unicorn.600.webp 2x'
+    assert image_preview_thumbnailer.thumbnail_srcset('thumbnails/unicorn.jpg', config) == 'thumbnails/unicorn.jpg 1x, thumbnails/unicorn.600.jpg 2x'
+
+def test_build_stats(local_server_url, tmp_path):
+    page = BLOG_PAGE_TEMPLATE.format(illustration_url=local_server_url + '/unicorn.jpg')
+    process_all_links_in_html(page, PluginConfig())
+    reset_build_caches()  # => new build
+    process_all_links_in_html(page, PluginConfig())
+    stats_filepath = tmp_path / 'stats.json'
+    report_build_stats(str(stats_filepath))
+    stats = json.loads(stats_filepath.read_text())
+    assert stats['counters']['thumbnails_downloaded'] == 1
+    assert stats['counters']['thumbnails_existing'] == 1
+    assert stats['counters']['bytes_downloaded'] > 0
+    assert stats['stages']['download_img']['calls'] == 1
+    assert stats['stages']['html_parsing']['calls'] == 2
+    host_stats = stats['hosts']['127.0.0.1']
+    assert host_stats['requests'] == sum(host_stats['latency_histogram']) == 1
+    assert host_stats['connections_opened'] >= 1
+    assert not STATS.summary()['stages']  # stats are reset once reported
+
 @pytest.mark.integration
 @pytest.mark.skip(reason="HTTP 403")
 def test_artstation():
@@ -63,7 +532,7 @@ def test_deviantart():
 def test_deviantart_mature_content():
     url = 'https://www.deviantart.com/eggboy122/art/Angel-maybe-697980132'
     out_html = process_all_links_in_html(BLOG_PAGE_TEMPLATE.format(illustration_url=url))
-    assert os.path.getsize("thumbnails/Angel-maybe-697980132.www.deviantart.com.none") == 0
+    assert read_none_marker("thumbnails/Angel-maybe-697980132.www.deviantart.com.none")['reason'] == 'no_image'
     assert '<img' not in out_html
 
 @pytest.mark.integration